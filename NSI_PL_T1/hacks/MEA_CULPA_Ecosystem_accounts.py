@@ -53,37 +53,346 @@ clc_to_ecosystem = {
 
 # Create a mapping for level1 only (extract first element of each tuple)
 clc_to_level1 = {clc: mapping[0] for clc, mapping in clc_to_ecosystem.items()}
+# ... and for level2 (second element of each tuple)
+clc_to_level2 = {clc: mapping[1] for clc, mapping in clc_to_ecosystem.items()}
 
-def reclassify_raster_level1(input_raster, output_raster):
+ecosystem_levels = {'level1': clc_to_level1, 'level2': clc_to_level2}
+
+def build_lookup_table(mapping, nodata_value, dtype=np.uint16):
     """
-    Reclassifies a large raster to level1 using windowed (block) processing to avoid high memory usage.
+    Builds a lookup table (LUT) for a CLC -> ecosystem mapping. Every index not in the mapping
+    holds the nodata value; the last entry is a sentinel for codes above the largest CLC code.
     """
-    with rasterio.open(input_raster) as src:
-        profile = src.profile.copy()
-        nodata_value = src.nodata if src.nodata is not None else 0
-        # Ensure nodata is within valid range (0-65535 for uint16)
-        if nodata_value < 0 or nodata_value > 65535:
-            nodata_value = 0
+    lut = np.full(max(mapping) + 2, fill_value=nodata_value, dtype=dtype)
+    for clc_value, eco_value in mapping.items():
+        lut[clc_value] = eco_value
+    return lut
+
+def reclassify_block_mask(data, mapping, nodata_value):
+    """Reference engine: one boolean mask per CLC code (one scan of the block per code)."""
+    data = data.astype(np.int32)
+    out_block = np.full(data.shape, fill_value=nodata_value, dtype=np.uint16)
+    for clc_value, eco_value in mapping.items():
+        out_block[data == clc_value] = eco_value
+    return out_block
 
+def reclassify_block_lut(data, lut):
+    """LUT engine: a single gather per block. Negative and out-of-range codes map to nodata."""
+    if not np.issubdtype(data.dtype, np.integer):
+        data = data.astype(np.int32)
+    return lut[np.clip(data, 0, lut.size - 1)]
+
+# Fastest level of each write_cog codec, for the COG intermediates
+_intermediate_levels = {'zstd': {'zstd_level': 1}, 'deflate': {'zlevel': 1}, 'lzw': {}}
+
+def _reclassify_profile(src, count, levels=('level1',), output_format='gtiff', codec='zstd'):
+    profile = src.profile.copy()
+    nodata_value = src.nodata if src.nodata is not None else 0
+    # Ensure nodata is within valid range (0-65535 for uint16)
+    if nodata_value < 0 or nodata_value > 65535:
+        nodata_value = 0
+    if output_format == 'gtiff':
         # Update profile to use uint16, LZW compression, and proper nodata
-        profile.update(dtype=rasterio.uint16, compress='lzw', nodata=nodata_value)
+        profile.update(dtype=rasterio.uint16, compress='lzw', nodata=nodata_value, count=count)
+        return profile, nodata_value
+
+    # 'cog': tiled intermediate, compressed at the fastest level of `codec` to keep temporary disk
+    # small, recompressed and given overviews by write_cog. Classes (level1 <= 11, level2 <= 114)
+    # and nodata fit in uint8 unless the input nodata is above 255.
+    max_value = max([nodata_value] + [max(ecosystem_levels[level].values()) for level in levels])
+    dtype = rasterio.uint8 if max_value <= 255 else rasterio.uint16
+    for key in ('compress', 'predictor', 'interleave'):
+        profile.pop(key, None)
+    profile.update(driver='GTiff', dtype=dtype, nodata=nodata_value, count=count, tiled=True,
+                   blockxsize=512, blockysize=512, BIGTIFF='IF_SAFER', compress=codec,
+                   **_intermediate_levels.get(codec.lower(), {}))
+    return profile, nodata_value
+
+def write_cog(input_raster, output_raster, codec='zstd', blocksize=512):
+    """
+    Copies a raster to a Cloud-Optimized GeoTIFF: tiled, compressed with `codec` ('zstd', 'deflate'
+    or 'lzw') and horizontal predictor, with internal overviews resampled by categorical mode.
+    """
+    from rasterio.shutil import copy as raster_copy
+    raster_copy(input_raster, output_raster, driver='COG', compress=codec.upper(), predictor='YES',
+                blocksize=blocksize, overviews='AUTO', overview_resampling='MODE', resampling='MODE',
+                bigtiff='IF_SAFER')
+    return output_raster
+
+def _check_reclassify_args(outputs, levels, engine):
+    if isinstance(outputs, dict):
+        levels = tuple(outputs)
+    unknown = [level for level in levels if level not in ecosystem_levels]
+    if unknown:
+        raise ValueError(f"Unknown ecosystem level(s): {unknown}")
+    if engine not in ('lut', 'mask'):
+        raise ValueError(f"Unknown reclassification engine: {engine}")
+    return tuple(levels)
+
+def _open_reclassify_outputs(src, outputs, levels, output_format='gtiff', codec='zstd'):
+    """
+    Opens the output raster(s) and returns (datasets, [(dataset, band) per level], luts, nodata,
+    cog_paths). For output_format='cog' the datasets are intermediates and cog_paths lists the
+    (intermediate, output) pairs to pass to write_cog once they are closed.
+    """
+    paths = [outputs[level] for level in levels] if isinstance(outputs, dict) else [outputs]
+    count = 1 if isinstance(outputs, dict) else len(levels)
+    profile, nodata_value = _reclassify_profile(src, count, levels, output_format, codec)
+    if output_format == 'cog':
+        cog_paths = [(f'{path}.tmp.tif', path) for path in paths]
+        paths = [tmp_path for tmp_path, _ in cog_paths]
+    elif output_format == 'gtiff':
+        cog_paths = []
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    dsts = [rasterio.open(path, 'w', **profile) for path in paths]
+    if isinstance(outputs, dict):
+        targets = [(dst, 1) for dst in dsts]
+    else:
+        targets = [(dsts[0], band) for band in range(1, len(levels) + 1)]
+    luts = [build_lookup_table(ecosystem_levels[level], nodata_value, dtype=profile['dtype']) for level in levels]
+    return dsts, targets, luts, nodata_value, cog_paths
+
+def _finish_cog_outputs(cog_paths, codec):
+    """Converts closed intermediates to their COG outputs; every intermediate is removed, also on errors."""
+    try:
+        for tmp_path, path in cog_paths:
+            write_cog(tmp_path, path, codec=codec)
+    finally:
+        _remove_cog_intermediates(cog_paths)
 
-        with rasterio.open(output_raster, 'w', **profile) as dst:
+def _remove_cog_intermediates(cog_paths):
+    import os
+    for tmp_path, _ in cog_paths:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _reclassify_block(data, levels, luts, nodata_value, engine):
+    if engine == 'lut':
+        return [reclassify_block_lut(data, lut) for lut in luts]
+    return [reclassify_block_mask(data, ecosystem_levels[level], nodata_value).astype(lut.dtype, copy=False)
+            for level, lut in zip(levels, luts)]
+
+def reclassify_raster_levels(input_raster, outputs, levels=('level1', 'level2'), engine='lut',
+                             workers=1, max_memory_mb=512, output_format='gtiff', codec='zstd'):
+    """
+    Reclassifies a CORINE raster to several ecosystem levels from a single read of every block.
+
+    outputs: a path (one band per level, in the order of `levels`) or a dict {level: path}
+             (one single-band file per level).
+    engine:  'lut' (one lookup-table pass per block) or 'mask' (the original per-class masking loop).
+    workers: > 1 runs the blocks through reclassify_rasters_parallel.
+    output_format: 'gtiff' (source layout, uint16, LZW) or 'cog' (Cloud-Optimized GeoTIFF with mode
+             overviews, uint8 when the classes allow it, compressed with `codec`, see write_cog).
+    """
+    if workers > 1:
+        reclassify_rasters_parallel([(input_raster, outputs)], levels=levels, engine=engine,
+                                    workers=workers, max_memory_mb=max_memory_mb,
+                                    output_format=output_format, codec=codec)
+        return outputs
+    levels = _check_reclassify_args(outputs, levels, engine)
+
+    with rasterio.open(input_raster) as src:
+        dsts, targets, luts, nodata_value, cog_paths = _open_reclassify_outputs(
+            src, outputs, levels, output_format, codec)
+        try:
             # Process the raster by its block windows to reduce memory usage
             for ji, window in src.block_windows(1):
-                # Read the current window from the raster
-                data = src.read(1, window=window).astype(np.int32)
-                # Create an output array for this block filled with the nodata value
-                level1_block = np.full(data.shape, fill_value=nodata_value, dtype=np.uint16)
-                # For each CLC code, assign the corresponding level1 value using the mapping dictionary
-                for clc_value, l1 in clc_to_level1.items():
-                    mask = data == clc_value
-                    level1_block[mask] = l1
-                # Write the processed block to the output raster
-                dst.write(level1_block, 1, window=window)
+                data = src.read(1, window=window)
+                out_blocks = _reclassify_block(data, levels, luts, nodata_value, engine)
+                for out_block, (dst, band) in zip(out_blocks, targets):
+                    dst.write(out_block, band, window=window)
+            for dst in dsts:
+                dst.close()
+            _finish_cog_outputs(cog_paths, codec)
+        finally:
+            for dst in dsts:
+                dst.close()
+            _remove_cog_intermediates(cog_paths)
+    return outputs
+
+def _reclassify_batch(input_raster, windows, levels, luts, nodata_value, engine):
+    """Worker task: reads and reclassifies a batch of windows with its own dataset handle."""
+    with rasterio.open(input_raster) as src:
+        return [_reclassify_block(src.read(1, window=window), levels, luts, nodata_value, engine)
+                for window in windows]
+
+def reclassify_rasters_parallel(jobs, levels=('level1', 'level2'), engine='lut', workers=4, max_memory_mb=512,
+                                output_format='gtiff', codec='zstd'):
+    """
+    Reclassifies one or more rasters with a shared thread pool.
+
+    jobs: list of (input_raster, outputs) pairs, `outputs` as in reclassify_raster_levels. Several
+          input years can be passed at once; their block windows are fed through the same pool.
+
+    The block windows of every job are grouped into batches that workers read and reclassify
+    (rasterio and numpy release the GIL, every worker opens its own dataset handle). The calling
+    thread is the only writer: it writes finished batches strictly in submission order, while up to
+    2 * workers batches are kept in flight, so reads stay ahead of the writer. Batch size is chosen
+    so that the in-flight batches (input and output blocks) stay below `max_memory_mb`.
+    """
+    from collections import Counter, deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    max_in_flight = 2 * workers
+    budget = max_memory_mb * 1024 * 1024 // max_in_flight
+
+    opened = []  # (src, dsts, cog_paths) per job
+    cog_paths = []
+    try:
+        tasks = []  # (job, windows, targets) in write order
+        for job_index, (input_raster, outputs) in enumerate(jobs):
+            job_levels = _check_reclassify_args(outputs, levels, engine)
+            src = rasterio.open(input_raster)
+            dsts, targets, luts, nodata_value, job_cog_paths = _open_reclassify_outputs(
+                src, outputs, job_levels, output_format, codec)
+            opened.append((src, dsts, job_cog_paths))
+            cog_paths += job_cog_paths
+            job = (job_index, input_raster, job_levels, luts, nodata_value)
+
+            bytes_per_pixel = np.dtype(src.dtypes[0]).itemsize + 2 * len(job_levels)
+            batch, batch_bytes = [], 0
+            for ji, window in src.block_windows(1):
+                batch.append(window)
+                batch_bytes += int(window.width) * int(window.height) * bytes_per_pixel
+                if batch_bytes >= budget:
+                    tasks.append((job, batch, targets))
+                    batch, batch_bytes = [], 0
+            if batch:
+                tasks.append((job, batch, targets))
+
+        remaining = Counter(job[0] for job, _, _ in tasks)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            conversions = []
+            task_iter = iter(tasks)
+
+            def submit_next():
+                task = next(task_iter, None)
+                if task is not None:
+                    (job_index, input_raster, job_levels, luts, nodata_value), windows, targets = task
+                    future = executor.submit(_reclassify_batch, input_raster, windows,
+                                             job_levels, luts, nodata_value, engine)
+                    pending.append((future, job_index, windows, targets))
+
+            for _ in range(max_in_flight):
+                submit_next()
+            while pending:
+                future, job_index, windows, targets = pending.popleft()
+                results = future.result()
+                submit_next()
+                for window, out_blocks in zip(windows, results):
+                    for out_block, (dst, band) in zip(out_blocks, targets):
+                        dst.write(out_block, band, window=window)
+                remaining[job_index] -= 1
+                _, dsts, job_cog_paths = opened[job_index]
+                if not remaining[job_index] and job_cog_paths:
+                    # The job's outputs are complete: convert them in the pool now instead of
+                    # keeping every intermediate until the last job is written
+                    for dst in dsts:
+                        dst.close()
+                    conversions.append(executor.submit(_finish_cog_outputs, job_cog_paths, codec))
+            for conversion in conversions:
+                conversion.result()
+    finally:
+        for src, dsts, _ in opened:
+            for dst in dsts:
+                dst.close()
+            src.close()
+        _remove_cog_intermediates(cog_paths)
+    return [outputs for _, outputs in jobs]
+
+def reclassify_raster_level1(input_raster, output_raster, engine='lut', workers=1, max_memory_mb=512,
+                             output_format='gtiff', codec='zstd'):
+    """
+    Reclassifies a large raster to level1 using windowed (block) processing to avoid high memory usage.
+    """
+    reclassify_raster_levels(input_raster, {'level1': output_raster}, engine=engine,
+                             workers=workers, max_memory_mb=max_memory_mb,
+                             output_format=output_format, codec=codec)
     return output_raster
 
-def compute_zonal_stats(raster_file, geojson_file, zone_type='NUTS0'):
+def raster_output_report(raster_files, overview_factor=16):
+    """
+    Size and read throughput of reclassified rasters (e.g. the 'gtiff' and 'cog' outputs of the same
+    input): full-resolution read by blocks, and a 1/overview_factor decimated read as done for map
+    display, which is served from internal overviews when the file has them.
+    """
+    import os
+    import time
+
+    rows = []
+    for path in raster_files:
+        with rasterio.open(path) as src:
+            t0 = time.perf_counter()
+            for ji, window in src.block_windows(1):
+                src.read(1, window=window)
+            full_read = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            src.read(1, out_shape=(max(1, src.height // overview_factor), max(1, src.width // overview_factor)))
+            overview_read = time.perf_counter() - t0
+            rows.append({
+                'file': path, 'size_mb': os.path.getsize(path) / 1024 / 1024, 'dtype': src.dtypes[0],
+                'compress': src.compression.value if src.compression else None,
+                'block': src.block_shapes[0], 'overviews': src.overviews(1),
+                'full_read_s': full_read, 'full_read_mpix_per_s': src.width * src.height / full_read / 1e6,
+                'overview_read_s': overview_read,
+            })
+    return pd.DataFrame(rows)
+
+def benchmark_reclassify_engines(input_raster, level='level1', max_blocks=None):
+    """
+    Times the masking loop against the LUT engine on the blocks of `input_raster` (compute only,
+    each block is read once and fed to both engines) and checks that both give identical output.
+    """
+    import time
+
+    mapping = ecosystem_levels[level]
+    timings = {'mask': 0.0, 'lut': 0.0}
+    n_pixels = 0
+    with rasterio.open(input_raster) as src:
+        nodata_value = _reclassify_profile(src, count=1)[1]
+        lut = build_lookup_table(mapping, nodata_value)
+        for i, (ji, window) in enumerate(src.block_windows(1)):
+            if max_blocks is not None and i >= max_blocks:
+                break
+            data = src.read(1, window=window)
+            t0 = time.perf_counter()
+            expected = reclassify_block_mask(data, mapping, nodata_value)
+            t1 = time.perf_counter()
+            result = reclassify_block_lut(data, lut)
+            t2 = time.perf_counter()
+            if not np.array_equal(expected, result):
+                raise AssertionError(f"LUT and mask engines disagree in block {ji}")
+            timings['mask'] += t1 - t0
+            timings['lut'] += t2 - t1
+            n_pixels += data.size
+
+    report = {'pixels': n_pixels}
+    for engine, seconds in timings.items():
+        report[f'{engine}_seconds'] = seconds
+        report[f'{engine}_mpix_per_s'] = n_pixels / seconds / 1e6 if seconds else float('inf')
+    report['speedup'] = timings['mask'] / timings['lut'] if timings['lut'] else float('inf')
+    print(f"Reclassify benchmark ({level}, {n_pixels} px): mask {timings['mask']:.2f}s, "
+          f"LUT {timings['lut']:.2f}s, speedup x{report['speedup']:.1f}")
+    return report
+
+def get_zone_name(row, idx, zone_type):
+    """Zone name based on zone type (see compute_zonal_stats)."""
+    if zone_type == 'NUTS0':
+        return row.get('NUTS_NAME', f'zone_{idx}')
+    elif zone_type in ('NUTS1', 'NUTS2', 'NUTS3'):
+        cntr = row.get('CNTR_CODE', '')
+        nuts_name = row.get('NUTS_NAME', '')
+        return f"{cntr}_{nuts_name}"
+    return f'zone_{idx}'
+
+def get_zone_ids(gdf):
+    """NUTS_ID per zone (used to roll statistics up the NUTS hierarchy), None when the field is missing."""
+    return gdf['NUTS_ID'].tolist() if 'NUTS_ID' in gdf.columns else None
+
+def compute_zonal_stats(raster_file, geojson_file, zone_type='NUTS0', engine='polygon', zone_cache_dir=None):
     """
     Computes area (in hectares) per ecosystem class within each zone.
     If the polygon’s bounding window is huge, the function subdivides it into smaller blocks to
@@ -91,7 +400,16 @@ def compute_zonal_stats(raster_file, geojson_file, zone_type='NUTS0'):
     
     zone_type: 'NUTS0' for country-level (uses field "NUTS_NAME"),
                'NUTS2' for region-level (combines "CNTR_CODE" and "NUTS_NAME").
+    engine:    'polygon' (rasterize and read every polygon's bounding window) or 'bincount'
+               (single scan of the raster, see compute_zonal_stats_bincount).
+    zone_cache_dir: directory of the persistent zone raster cache (bincount engine only).
     """
+    if engine == 'bincount':
+        return compute_zonal_stats_bincount(raster_file, geojson_file, zone_type=zone_type,
+                                            zone_cache_dir=zone_cache_dir)
+    elif engine != 'polygon':
+        raise ValueError(f"Unknown zonal statistics engine: {engine}")
+
     import rasterio
     from rasterio.windows import from_bounds, transform as window_transform_func, Window
     from rasterio.features import rasterize
@@ -116,15 +434,7 @@ def compute_zonal_stats(raster_file, geojson_file, zone_type='NUTS0'):
         max_block = 1000  # maximum block size to process at one time
         for idx, row in gdf.iterrows():
             geom = row.geometry
-            # Define zone name based on zone type
-            if zone_type == 'NUTS0':
-                zone_name = row.get('NUTS_NAME', f'zone_{idx}')
-            elif zone_type == 'NUTS2':
-                cntr = row.get('CNTR_CODE', '')
-                nuts_name = row.get('NUTS_NAME', '')
-                zone_name = f"{cntr}_{nuts_name}"
-            else:
-                zone_name = f'zone_{idx}'
+            zone_name = get_zone_name(row, idx, zone_type)
 
             # Determine the window that covers the geometry bounds
             bounds = geom.bounds  # (minx, miny, maxx, maxy)
@@ -197,6 +507,551 @@ def compute_zonal_stats(raster_file, geojson_file, zone_type='NUTS0'):
     df = pd.DataFrame(stats_list)
     return df
 
+def iter_chunk_windows(width, height, chunk_size):
+    """Yield rasterio Windows of at most chunk_size x chunk_size covering the raster."""
+    from rasterio.windows import Window
+    for row_off in range(0, height, chunk_size):
+        for col_off in range(0, width, chunk_size):
+            yield Window(col_off, row_off, min(chunk_size, width - col_off), min(chunk_size, height - row_off))
+
+def zone_id_dtype(n_zones):
+    return 'uint16' if n_zones < np.iinfo(np.uint16).max else 'int32'
+
+def burn_zone_block(gdf, window, transform, dtype):
+    """
+    Rasterizes all zones intersecting the window into a zone-ID block aligned with the raster grid.
+    Zone IDs are the row positions in gdf + 1, 0 means outside every zone.
+    """
+    from rasterio.windows import bounds as window_bounds, transform as window_transform_func
+    from shapely.geometry import box
+
+    out_shape = (int(window.height), int(window.width))
+    positions = gdf.sindex.query(box(*window_bounds(window, transform)))
+    shapes = [(gdf.geometry.iloc[i], int(i) + 1) for i in positions
+              if gdf.geometry.iloc[i] is not None and not gdf.geometry.iloc[i].is_empty]
+    if not shapes:
+        return np.zeros(out_shape, dtype=dtype)
+    return rasterize(shapes, out_shape=out_shape, transform=window_transform_func(window, transform),
+                     fill=0, dtype=dtype)
+
+def accumulate_zone_class_counts(counts, zone_block, class_block, nodata):
+    """
+    Adds the (zone, class) pixel counts of one block to `counts` (zones+1 x classes) with a single
+    bincount over the combined key zone * n_classes + class. Grows the class axis when needed.
+    """
+    valid = (zone_block > 0) & (class_block != nodata) & (class_block >= 0)
+    if not valid.any():
+        return counts
+    zones = zone_block[valid].astype(np.int64)
+    classes = class_block[valid].astype(np.int64)
+    n_classes = max(counts.shape[1], int(classes.max()) + 1)
+    if n_classes > counts.shape[1]:
+        counts = np.pad(counts, ((0, 0), (0, n_classes - counts.shape[1])))
+    counts += np.bincount(zones * n_classes + classes, minlength=counts.size).reshape(counts.shape)
+    return counts
+
+class ZoneAccounts:
+    """
+    Compact accounts table: a zone index plus a dense zones x classes array of int64 pixel counts
+    (one column per class code in `classes`) and the pixel area in hectares.
+
+    kind='stats' holds the pixel counts of one year, kind='diff' the signed change between two
+    years (`later - earlier`). Difference, totals, shares and class renaming are vectorized over
+    the array; tables in the DataFrame layouts are only built at export (to_dataframe / to_table).
+    """
+
+    def __init__(self, zones, counts, classes, pixel_area, zone_type='NUTS0', kind='stats'):
+        self.zones = list(zones)
+        self.counts = np.asarray(counts, dtype=np.int64).reshape(len(self.zones), len(classes))
+        self.classes = np.asarray(classes, dtype=np.int64)
+        self.pixel_area = pixel_area
+        self.zone_type = zone_type
+        self.kind = kind
+
+    @classmethod
+    def from_counts(cls, counts, zone_names, zone_type, pixel_area):
+        """From a (zones+1 x classes) bincount array (row 0 = outside every zone, column = class code)."""
+        counts = counts[1:]
+        classes = np.flatnonzero(counts.sum(axis=0))
+        return cls(zone_names, counts[:, classes], classes, pixel_area, zone_type)
+
+    @classmethod
+    def from_dataframe(cls, df, zone_type, pixel_area):
+        """From a compute_zonal_stats DataFrame (areas in ECO_k columns are converted back to counts)."""
+        eco_cols = [col for col in df.columns if col.startswith('ECO_') and not col.endswith('_Diff')]
+        classes = [int(col[4:]) for col in eco_cols]
+        areas = df[eco_cols].apply(pd.to_numeric, errors='coerce').fillna(0).to_numpy(dtype=float)
+        return cls(df['Zone'], np.rint(areas / pixel_area), classes, pixel_area, zone_type)
+
+    @property
+    def zone_label(self):
+        return 'Country' if self.zone_type == 'NUTS0' else 'Region'
+
+    @property
+    def areas(self):
+        return self.counts * self.pixel_area
+
+    def reindex(self, zones, classes):
+        """Same accounts on another zone index and class list (missing entries are zero)."""
+        counts = np.zeros((len(zones), len(classes)), dtype=np.int64)
+        zone_pos = {zone: i for i, zone in enumerate(self.zones)}
+        class_pos = {int(k): i for i, k in enumerate(self.classes)}
+        rows = [(i, zone_pos[zone]) for i, zone in enumerate(zones) if zone in zone_pos]
+        cols = [(j, class_pos[int(k)]) for j, k in enumerate(classes) if int(k) in class_pos]
+        if rows and cols:
+            dst_rows, src_rows = map(list, zip(*rows))
+            dst_cols, src_cols = map(list, zip(*cols))
+            counts[np.ix_(dst_rows, dst_cols)] = self.counts[np.ix_(src_rows, src_cols)]
+        return ZoneAccounts(zones, counts, classes, self.pixel_area, self.zone_type, self.kind)
+
+    def __sub__(self, other):
+        """`accounts_2018 - accounts_2012`: change per zone and class, as a kind='diff' table."""
+        known = set(self.zones)
+        zones = self.zones + [zone for zone in other.zones if zone not in known]
+        classes = np.union1d(self.classes, other.classes)
+        diff = self.reindex(zones, classes).counts - other.reindex(zones, classes).counts
+        return ZoneAccounts(zones, diff, classes, self.pixel_area, self.zone_type, kind='diff')
+
+    def totals(self):
+        """Area per zone (ha) over all classes."""
+        return self.areas.sum(axis=1)
+
+    def shares(self):
+        """Share (%) of every class in its zone's total area, 0 for empty zones."""
+        total = self.totals()[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total != 0, self.areas / total * 100, 0)
+
+    def to_dataframe(self):
+        """compute_zonal_stats layout (kind='stats') or compute_difference layout (kind='diff')."""
+        result = {'Zone': self.zones}
+        if self.kind == 'diff':
+            for j, eco_class in enumerate(self.classes):
+                result[f'ECO_{eco_class}_Diff'] = self.areas[:, j]
+            return pd.DataFrame(result)
+        if self.zone_type in nuts_zone_labels:
+            result[self.zone_label] = self.zones
+        # Like the polygon engine, classes absent from a zone are left empty (NaN)
+        for j, eco_class in enumerate(self.classes):
+            result[f'ECO_{eco_class}'] = np.where(self.counts[:, j] > 0, self.areas[:, j], np.nan)
+        return pd.DataFrame(result)
+
+    def to_table(self, class_names=None):
+        """
+        Export table, same layout as sort_and_rename + add_totals (+ add_share_columns for stats):
+        named class columns, a Total column and a Total row, plus share columns for stats.
+        """
+        class_names = ecosystem_classes if class_names is None else class_names
+        class_pos = {int(k): j for j, k in enumerate(self.classes)}
+        named = [(name, class_pos[k]) for k, name in class_names.items() if k in class_pos]
+        cols = [j for _, j in named]
+        values = self.areas[:, cols].astype(float)
+        if self.kind == 'stats':
+            values[self.counts[:, cols] == 0] = np.nan
+            total = np.nansum(values, axis=1)
+            suffix, label = '', self.zone_label
+        else:
+            # As in add_totals, Total only sums area columns, which diff tables do not have
+            total = np.zeros(len(self.zones))
+            suffix, label = ' Diff', None
+
+        order = np.argsort(np.asarray(self.zones, dtype=object), kind='stable')
+        values, total = values[order], total[order]
+        values = np.vstack([values, np.nansum(values, axis=0)])
+        total = np.append(total, total.sum())
+
+        zones = [self.zones[i] for i in order] + ['Total']
+        df = pd.DataFrame({'Zone': zones})
+        if label is not None:
+            df[label] = zones
+        for (name, _), column in zip(named, values.T):
+            df[name + suffix] = column
+        df['Total'] = total
+        if self.kind == 'stats':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                shares = np.where(total[:, None] != 0, values / total[:, None] * 100, 0)
+            for (name, _), column in zip(named, shares.T):
+                df[name + ' Share'] = column
+        return df
+
+nuts_zone_labels = ('NUTS0', 'NUTS1', 'NUTS2', 'NUTS3')
+
+def zone_counts_to_dataframe(counts, zone_names, zone_type, pixel_area):
+    """Converts a (zones+1 x classes) count array to the compute_zonal_stats DataFrame layout."""
+    return ZoneAccounts.from_counts(counts, zone_names, zone_type, pixel_area).to_dataframe()
+
+# ----- Persistent cache of rasterized zone grids -----
+# Entries are tiled, DEFLATE-compressed zone-ID GeoTIFFs plus an index.json with the zone names,
+# keyed on the GeoJSON contents, the zone field and the raster grid (CRS, transform, shape).
+
+def _file_sha256(path, block_size=1 << 20):
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def zone_cache_key(geojson_file, zone_type, crs, transform, shape):
+    import hashlib
+    parts = [_file_sha256(geojson_file), zone_type, crs.to_wkt() if crs else '',
+             ','.join(repr(float(v)) for v in tuple(transform)[:6]), f'{shape[0]}x{shape[1]}']
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()[:32]
+
+def _load_zone_cache_index(cache_dir):
+    import json
+    import os
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+def _save_zone_cache_index(cache_dir, index):
+    import json
+    import os
+    tmp_path = os.path.join(cache_dir, 'index.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, os.path.join(cache_dir, 'index.json'))
+
+def list_zone_cache(cache_dir):
+    """Returns the cache entries as a DataFrame (one row per zone raster, most recently used first)."""
+    index = _load_zone_cache_index(cache_dir)
+    rows = [{'key': key, **{k: v for k, v in entry.items() if k not in ('zone_names', 'zone_ids')},
+             'zones': len(entry['zone_names'])} for key, entry in index.items()]
+    df = pd.DataFrame(rows)
+    return df.sort_values('last_used', ascending=False) if not df.empty else df
+
+def invalidate_zone_cache(cache_dir, key=None, geojson_file=None):
+    """
+    Removes cache entries: a single entry by key, every entry built from geojson_file, or, when
+    neither is given, the whole cache. Returns the removed keys.
+    """
+    import os
+    index = _load_zone_cache_index(cache_dir)
+    removed = [k for k, entry in index.items()
+               if (key is None or k == key) and
+               (geojson_file is None or os.path.abspath(geojson_file) == entry['geojson'])]
+    for k in removed:
+        raster_path = os.path.join(cache_dir, index.pop(k)['file'])
+        if os.path.exists(raster_path):
+            os.remove(raster_path)
+    _save_zone_cache_index(cache_dir, index)
+    return removed
+
+def _evict_zone_cache(cache_dir, index, max_bytes, keep):
+    """Drops least recently used entries (never `keep`) until the cache fits in max_bytes."""
+    import os
+    total = sum(entry['size'] for entry in index.values())
+    for k in sorted(index, key=lambda k: index[k]['last_used']):
+        if total <= max_bytes:
+            break
+        if k == keep:
+            continue
+        entry = index.pop(k)
+        total -= entry['size']
+        raster_path = os.path.join(cache_dir, entry['file'])
+        if os.path.exists(raster_path):
+            os.remove(raster_path)
+        print(f"Evicted zone raster {k} ({entry['geojson']}, {entry['zone_type']}) from cache")
+
+def write_zone_raster(gdf, output_file, crs, transform, width, height, chunk_size=2048):
+    """Burns all zones of gdf into a tiled, compressed zone-ID GeoTIFF on the given grid."""
+    dtype = zone_id_dtype(len(gdf))
+    profile = {
+        'driver': 'GTiff', 'dtype': dtype, 'count': 1, 'crs': crs, 'transform': transform,
+        'width': width, 'height': height, 'nodata': 0, 'tiled': True,
+        'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate', 'predictor': 2,
+    }
+    with rasterio.open(output_file, 'w', **profile) as dst:
+        for window in iter_chunk_windows(width, height, chunk_size):
+            zone_block = burn_zone_block(gdf, window, transform, dtype)
+            if zone_block.any():
+                dst.write(zone_block, 1, window=window)
+    return output_file
+
+def get_zone_raster(geojson_file, zone_type, raster_file, cache_dir, max_cache_mb=2048):
+    """
+    Returns (zone_raster_path, zone_names, zone_ids) for the zones of geojson_file on the grid of raster_file,
+    rasterizing them only when no cache entry exists for the same GeoJSON contents, zone field and grid.
+    """
+    import os
+    import time
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with rasterio.open(raster_file) as src:
+        crs, transform, width, height = src.crs, src.transform, src.width, src.height
+    key = zone_cache_key(geojson_file, zone_type, crs, transform, (height, width))
+    index = _load_zone_cache_index(cache_dir)
+    entry = index.get(key)
+    if entry is not None and os.path.exists(os.path.join(cache_dir, entry['file'])):
+        entry['last_used'] = time.time()
+        _save_zone_cache_index(cache_dir, index)
+        return os.path.join(cache_dir, entry['file']), entry['zone_names'], entry.get('zone_ids')
+
+    print(f"Rasterizing zones of {geojson_file} ({zone_type}) into cache ...")
+    gdf = gpd.read_file(geojson_file)
+    if gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+    zone_names = [get_zone_name(row, idx, zone_type) for idx, row in gdf.iterrows()]
+    zone_ids = get_zone_ids(gdf)
+    file_name = f'zones_{key}.tif'
+    write_zone_raster(gdf, os.path.join(cache_dir, file_name), crs, transform, width, height)
+
+    index = _load_zone_cache_index(cache_dir)
+    index[key] = {
+        'file': file_name, 'geojson': os.path.abspath(geojson_file), 'zone_type': zone_type,
+        'shape': [height, width], 'size': os.path.getsize(os.path.join(cache_dir, file_name)),
+        'created': time.time(), 'last_used': time.time(), 'zone_names': zone_names, 'zone_ids': zone_ids,
+    }
+    _evict_zone_cache(cache_dir, index, max_cache_mb * 1024 * 1024, keep=key)
+    _save_zone_cache_index(cache_dir, index)
+    return os.path.join(cache_dir, file_name), zone_names, zone_ids
+
+def iter_zone_blocks(raster_file, geojson_file, zone_type, chunk_size=2048, zone_cache_dir=None, max_cache_mb=2048):
+    """
+    Returns (zone_names, zone_ids, blocks) where blocks yields (window, zone_block) for every chunk of the
+    raster grid that intersects at least one zone. Zone blocks come from the zone raster cache when
+    zone_cache_dir is set, otherwise they are burned on the fly.
+    """
+    with rasterio.open(raster_file) as src:
+        crs, transform, width, height = src.crs, src.transform, src.width, src.height
+
+    if zone_cache_dir is not None:
+        zone_raster, zone_names, zone_ids = get_zone_raster(geojson_file, zone_type, raster_file,
+                                                            zone_cache_dir, max_cache_mb=max_cache_mb)
+
+        def blocks():
+            with rasterio.open(zone_raster) as zones:
+                for window in iter_chunk_windows(width, height, chunk_size):
+                    zone_block = zones.read(1, window=window)
+                    if zone_block.any():
+                        yield window, zone_block
+        return zone_names, zone_ids, blocks()
+
+    # Read the GeoJSON file and reproject if necessary
+    gdf = gpd.read_file(geojson_file)
+    if gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+    zone_names = [get_zone_name(row, idx, zone_type) for idx, row in gdf.iterrows()]
+    zone_ids = get_zone_ids(gdf)
+    dtype = zone_id_dtype(len(gdf))
+
+    def blocks():
+        for window in iter_chunk_windows(width, height, chunk_size):
+            zone_block = burn_zone_block(gdf, window, transform, dtype)
+            if zone_block.any():
+                yield window, zone_block
+    return zone_names, zone_ids, blocks()
+
+def compute_zonal_stats_bincount(raster_file, geojson_file, zone_type='NUTS0', chunk_size=2048,
+                                 zone_cache_dir=None, max_cache_mb=2048):
+    """
+    Single-pass variant of compute_zonal_stats. The raster is scanned once in chunks; for each chunk
+    all zones are burned into a zone-ID grid aligned with the class raster and the (zone, class)
+    counts are accumulated with one bincount. Returns the same DataFrame layout.
+
+    Every pixel is counted in exactly one zone (the one rasterization burns last at its centre).
+    Counts therefore equal a reference that rasterizes every polygon on its own only for
+    non-overlapping zones with shared edges on pixel boundaries; where neighbours meet inside a
+    pixel, separate rasterizations can put that pixel in both zones or in neither.
+
+    With zone_cache_dir the zone-ID grid is taken from (or added to) the on-disk zone raster cache,
+    so repeated runs on the same zones and grid skip rasterization entirely.
+    """
+    counts, zone_names, zone_ids, pixel_area = compute_zone_class_counts(
+        raster_file, geojson_file, zone_type, chunk_size, zone_cache_dir, max_cache_mb)
+    return zone_counts_to_dataframe(counts, zone_names, zone_type, pixel_area)
+
+def compute_zone_class_counts(raster_file, geojson_file, zone_type='NUTS0', chunk_size=2048,
+                              zone_cache_dir=None, max_cache_mb=2048):
+    """Single scan of the raster; returns (counts, zone_names, zone_ids, pixel_area), counts is zones+1 x classes."""
+    zone_names, zone_ids, zone_blocks = iter_zone_blocks(raster_file, geojson_file, zone_type, chunk_size,
+                                                         zone_cache_dir, max_cache_mb)
+    with rasterio.open(raster_file) as src:
+        nodata = src.nodata if src.nodata is not None else 0
+        # Calculate pixel area (in hectares)
+        pixel_area = abs(src.transform[0]) * abs(src.transform[4]) / 10000
+
+        counts = np.zeros((len(zone_names) + 1, 1), dtype=np.int64)
+        for window, zone_block in zone_blocks:
+            class_block = src.read(1, window=window)
+            counts = accumulate_zone_class_counts(counts, zone_block, class_block, nodata)
+    return counts, zone_names, zone_ids, pixel_area
+
+# ----- Change accounts: both years and the class-to-class transitions in one joint scan -----
+
+def accumulate_transition_counts(counts, zone_block, from_block, to_block, from_nodata, to_nodata):
+    """
+    Adds the per-zone (from-class, to-class) pixel counts of one block to `counts`
+    (zones+1 x classes x classes) with one bincount. Nodata in either year is counted in class 0,
+    so the from and to marginals equal the single-year histograms.
+    """
+    from_cls = np.where((from_block == from_nodata) | (from_block < 0), 0, from_block).astype(np.int64)
+    to_cls = np.where((to_block == to_nodata) | (to_block < 0), 0, to_block).astype(np.int64)
+    valid = (zone_block > 0) & ((from_cls > 0) | (to_cls > 0))
+    if not valid.any():
+        return counts
+    zones = zone_block[valid].astype(np.int64)
+    from_cls, to_cls = from_cls[valid], to_cls[valid]
+    n_classes = max(counts.shape[1], int(max(from_cls.max(), to_cls.max())) + 1)
+    if n_classes > counts.shape[1]:
+        grow = n_classes - counts.shape[1]
+        counts = np.pad(counts, ((0, 0), (0, grow), (0, grow)))
+    key = (zones * n_classes + from_cls) * n_classes + to_cls
+    counts += np.bincount(key, minlength=counts.size).reshape(counts.shape)
+    return counts
+
+def transitions_to_dataframe(counts, zone_names, zone_type, pixel_area):
+    """Long table of the non-zero transitions: Zone, Country/Region, From, To, Area (class 0 = nodata)."""
+    zone_idx, from_cls, to_cls = np.nonzero(counts[1:])
+    names = np.asarray(zone_names, dtype=object)[zone_idx]
+    result = {'Zone': names}
+    if zone_type == 'NUTS0':
+        result['Country'] = names
+    elif zone_type in ('NUTS1', 'NUTS2', 'NUTS3'):
+        result['Region'] = names
+    result['From'] = from_cls
+    result['To'] = to_cls
+    result['Area'] = counts[1:][zone_idx, from_cls, to_cls] * pixel_area
+    return pd.DataFrame(result)
+
+def compute_change_accounts(raster_from, raster_to, geojson_file, zone_type='NUTS0', chunk_size=2048,
+                            zone_cache_dir=None, max_cache_mb=2048):
+    """
+    Reads two reclassified rasters on the same grid block by block at the same time and accumulates
+    a per-zone class-to-class transition matrix in one pass.
+
+    Returns (stats_from, stats_to, diff, transitions): the two single-year tables in the
+    compute_zonal_stats layout, the net difference in the compute_difference layout and the
+    long transitions table (see transitions_to_dataframe).
+    """
+    counts, zone_names, zone_ids, pixel_area = compute_transition_counts(
+        raster_from, raster_to, geojson_file, zone_type, chunk_size, zone_cache_dir, max_cache_mb)
+    return change_accounts_from_counts(counts, zone_names, zone_type, pixel_area)
+
+def compute_transition_counts(raster_from, raster_to, geojson_file, zone_type='NUTS0', chunk_size=2048,
+                              zone_cache_dir=None, max_cache_mb=2048):
+    """Joint scan of both rasters; returns (counts, zone_names, zone_ids, pixel_area), counts is zones+1 x from x to."""
+    zone_names, zone_ids, zone_blocks = iter_zone_blocks(raster_from, geojson_file, zone_type, chunk_size,
+                                                         zone_cache_dir, max_cache_mb)
+    with rasterio.open(raster_from) as src_from, rasterio.open(raster_to) as src_to:
+        if (src_from.shape != src_to.shape or src_from.transform != src_to.transform
+                or src_from.crs != src_to.crs):
+            raise ValueError(f"{raster_from} and {raster_to} are not on the same grid")
+        from_nodata = src_from.nodata if src_from.nodata is not None else 0
+        to_nodata = src_to.nodata if src_to.nodata is not None else 0
+        # Calculate pixel area (in hectares)
+        pixel_area = abs(src_from.transform[0]) * abs(src_from.transform[4]) / 10000
+
+        counts = np.zeros((len(zone_names) + 1, 1, 1), dtype=np.int64)
+        for window, zone_block in zone_blocks:
+            counts = accumulate_transition_counts(counts, zone_block, src_from.read(1, window=window),
+                                                  src_to.read(1, window=window), from_nodata, to_nodata)
+    return counts, zone_names, zone_ids, pixel_area
+
+def change_accounts_from_counts(counts, zone_names, zone_type, pixel_area, as_accounts=False):
+    """
+    Builds (stats_from, stats_to, diff, transitions) from a zones+1 x from x to count array.
+    With as_accounts the first three are ZoneAccounts instead of DataFrames.
+    """
+    # Marginals give the single-year histograms (class 0 = nodata is dropped)
+    from_counts = counts.sum(axis=2)
+    to_counts = counts.sum(axis=1)
+    from_counts[:, 0] = 0
+    to_counts[:, 0] = 0
+    stats_from = ZoneAccounts.from_counts(from_counts, zone_names, zone_type, pixel_area)
+    stats_to = ZoneAccounts.from_counts(to_counts, zone_names, zone_type, pixel_area)
+    diff = stats_to - stats_from
+
+    transitions = transitions_to_dataframe(counts, zone_names, zone_type, pixel_area)
+    if as_accounts:
+        return stats_from, stats_to, diff, transitions
+    return stats_from.to_dataframe(), stats_to.to_dataframe(), diff.to_dataframe(), transitions
+
+# ----- Roll-up of zone counts through the NUTS hierarchy -----
+# NUTS regions nest exactly, and the level of a region is given by the length of its NUTS_ID
+# (e.g. PL, PL9, PL91, PL911), so coarser levels are sums over NUTS_ID prefixes.
+nuts_id_length = {'NUTS0': 2, 'NUTS1': 3, 'NUTS2': 4, 'NUTS3': 5}
+
+def rollup_zone_counts(counts, fine_ids, coarse_ids):
+    """
+    Sums a (fine zones+1 x ...) count array into (coarse zones+1 x ...) by NUTS_ID prefix.
+    Fine zones whose prefix is not among coarse_ids end up in row 0 (outside every zone).
+    """
+    prefix_len = len(coarse_ids[0]) if coarse_ids else 0
+    position = {zone_id: i + 1 for i, zone_id in enumerate(coarse_ids)}
+    target = np.array([0] + [position.get(zone_id[:prefix_len], 0) for zone_id in fine_ids], dtype=np.int64)
+    rolled = np.zeros((len(coarse_ids) + 1,) + counts.shape[1:], dtype=counts.dtype)
+    np.add.at(rolled, target, counts)
+    return rolled
+
+def nuts_zone_table(level, fine_ids, geojson_file=None):
+    """
+    (zone_ids, zone_names) of a coarser NUTS level. Names come from the level's own GeoJSON attributes
+    when given (no geometry is read), otherwise the NUTS_ID prefixes of the finest zones are used.
+    """
+    if geojson_file is not None:
+        attrs = gpd.read_file(geojson_file, ignore_geometry=True)
+        return attrs['NUTS_ID'].tolist(), [get_zone_name(row, idx, level) for idx, row in attrs.iterrows()]
+    zone_ids = sorted({zone_id[:nuts_id_length[level]] for zone_id in fine_ids})
+    return zone_ids, list(zone_ids)
+
+def _rollup_levels(counts, zone_names, zone_ids, geojson_files, finest_level):
+    """Yields (level, counts, zone_names) for the finest level and every coarser level in geojson_files."""
+    if zone_ids is None:
+        raise ValueError(f"{geojson_files[finest_level]} has no NUTS_ID field, cannot roll up")
+    for level, geojson_file in geojson_files.items():
+        if level == finest_level:
+            yield level, counts, zone_names
+            continue
+        if nuts_id_length[level] >= nuts_id_length[finest_level]:
+            raise ValueError(f"{level} is not coarser than the finest level {finest_level}")
+        coarse_ids, coarse_names = nuts_zone_table(level, zone_ids, geojson_file)
+        yield level, rollup_zone_counts(counts, zone_ids, coarse_ids), coarse_names
+
+def compute_zonal_stats_hierarchy(raster_file, geojson_files, finest_level='NUTS2', engine='bincount',
+                                  zone_cache_dir=None, as_accounts=False):
+    """
+    Computes class histograms once at the finest NUTS level and derives the coarser levels by summing
+    through the NUTS_ID prefix hierarchy, with no further raster reads.
+
+    geojson_files: {level: geojson file or None}; the finest level needs its file, coarser levels only
+                   use theirs for zone names and order (None: zones are named by NUTS_ID).
+    Returns {level: DataFrame in the compute_zonal_stats layout}, or {level: ZoneAccounts} with
+    as_accounts. With engine='polygon' every level is computed independently (original behaviour).
+    """
+    if engine != 'bincount':
+        tables = {level: compute_zonal_stats(raster_file, geojson_file, zone_type=level, engine=engine)
+                  for level, geojson_file in geojson_files.items()}
+        if not as_accounts:
+            return tables
+        with rasterio.open(raster_file) as src:
+            pixel_area = abs(src.transform[0]) * abs(src.transform[4]) / 10000
+        return {level: ZoneAccounts.from_dataframe(ensure_numeric(df), level, pixel_area)
+                for level, df in tables.items()}
+    counts, zone_names, zone_ids, pixel_area = compute_zone_class_counts(
+        raster_file, geojson_files[finest_level], finest_level, zone_cache_dir=zone_cache_dir)
+    accounts = {level: ZoneAccounts.from_counts(level_counts, level_names, level, pixel_area)
+                for level, level_counts, level_names in
+                _rollup_levels(counts, zone_names, zone_ids, geojson_files, finest_level)}
+    if as_accounts:
+        return accounts
+    return {level: level_accounts.to_dataframe() for level, level_accounts in accounts.items()}
+
+def compute_change_accounts_hierarchy(raster_from, raster_to, geojson_files, finest_level='NUTS2',
+                                      zone_cache_dir=None, as_accounts=False):
+    """
+    compute_change_accounts at the finest NUTS level, rolled up to the coarser levels of geojson_files
+    (see compute_zonal_stats_hierarchy). Returns {level: (stats_from, stats_to, diff, transitions)}.
+    """
+    counts, zone_names, zone_ids, pixel_area = compute_transition_counts(
+        raster_from, raster_to, geojson_files[finest_level], finest_level, zone_cache_dir=zone_cache_dir)
+    return {level: change_accounts_from_counts(level_counts, level_names, level, pixel_area, as_accounts)
+            for level, level_counts, level_names in
+            _rollup_levels(counts, zone_names, zone_ids, geojson_files, finest_level)}
+
 def ensure_numeric(df):
     for col in df.columns:
         if col.startswith('ECO_'):
@@ -228,7 +1083,7 @@ def compute_difference(df_2012, df_2018, key='Zone'):
     
     return diff_df
 
-# ----- Process input rasters for each year -----
+# ----- Configuration -----
 # According to your instructions the file for "year 2012" is:
 raster_2012_input = "U2018_CLC2012_v2020_20u1.tif"
 # and for "year 2018" is:
@@ -236,34 +1091,43 @@ raster_2018_input = "U2018_CLC2018_v2020_20u1.tif"
 
 raster_2012_output = "2012_level1_EA.tif"
 raster_2018_output = "2018_level1_EA.tif"
+raster_2012_level2_output = "2012_level2_EA.tif"
+raster_2018_level2_output = "2018_level2_EA.tif"
 
-print("Reclassifying rasters to level1 ...")
-reclassify_raster_level1(raster_2012_input, raster_2012_output)
-reclassify_raster_level1(raster_2018_input, raster_2018_output)
+# Set to True to time the LUT engine against the original masking loop before processing
+run_reclassify_benchmark = False
+
+# Worker threads and memory ceiling (MB of blocks in flight) for the reclassification pool
+reclassify_workers = 4
+reclassify_max_memory_mb = 1024
+# 'cog' writes tiled Cloud-Optimized GeoTIFFs with mode overviews (uint8, `reclassify_codec` with
+# predictor); 'gtiff' keeps the source layout with uint16 and LZW
+reclassify_output_format = 'cog'
+reclassify_codec = 'zstd'
 
-# ----- Compute zonal statistics based on geojson files -----
 # Geojson files (ensure they are correctly formatted)
 nuts0_file = "NUTS0_3M_EUROPE.geojson"  # Country-level boundaries; uses field NUTS_NAME
 nuts2_file = "NUTS2_3M_EUROPE.geojson"  # Regional boundaries; combines CNTR_CODE and NUTS_NAME
-print("Computing zonal statistics for NUTS0 (countries) ...")
-stats_2012_country = compute_zonal_stats(raster_2012_output, nuts0_file, zone_type='NUTS0')
-stats_2018_country = compute_zonal_stats(raster_2018_output, nuts0_file, zone_type='NUTS0')
-
-# Ensure numeric types
-stats_2012_country = ensure_numeric(stats_2012_country)
-stats_2018_country = ensure_numeric(stats_2018_country)
+# 'bincount' scans each raster once; 'polygon' is the original per-polygon engine
+zonal_engine = 'bincount'
+# Rasterized zones are cached here, keyed on the GeoJSON contents and the raster grid
+zone_cache_dir = "zone_cache"
+# Statistics are computed once at the finest level and rolled up to the coarser ones through NUTS_ID.
+# Further levels can be added here (e.g. 'NUTS1': None, named by NUTS_ID); NUTS3 as finest needs its file.
+finest_level = 'NUTS2'
+nuts_files = {'NUTS0': nuts0_file, 'NUTS2': nuts2_file}
 
-diff_country = compute_difference(stats_2012_country, stats_2018_country, key='Zone')
+# Set to True to read both years together and also get class-to-class transitions (one scan in total)
+change_accounts = True
 
-print("Computing zonal statistics for NUTS2 (regions) ...")
-stats_2012_nuts2 = compute_zonal_stats(raster_2012_output, nuts2_file, zone_type='NUTS2')
-stats_2018_nuts2 = compute_zonal_stats(raster_2018_output, nuts2_file, zone_type='NUTS2')
+output_excel = "ecosystem_areas_comparison.xlsx"
 
-# Ensure numeric types
-stats_2012_nuts2 = ensure_numeric(stats_2012_nuts2)
-stats_2018_nuts2 = ensure_numeric(stats_2018_nuts2)
+# Formats of the zone layers: 'parquet' (GeoParquet), 'fgb' (FlatGeobuf) and/or 'geojson'
+# (the per-table GeoJSON files the dashboard is built from)
+export_formats = ('parquet', 'geojson')
 
-diff_nuts2 = compute_difference(stats_2012_nuts2, stats_2018_nuts2, key='Zone')
+# Outputs of every pipeline step are cached here under a hash of the step's inputs and parameters
+pipeline_cache_dir = "pipeline_cache"
 
 # Define ecosystem class renaming and sorting
 ecosystem_classes = {
@@ -334,66 +1198,324 @@ def add_share_columns(df):
             df[share_col] = np.where(df["Total"] != 0, df[eco_name] / df["Total"] * 100, 0)
     return df
 
-# Apply sorting and renaming
-stats_2012_country = sort_and_rename(stats_2012_country, zone_type='Country')
-stats_2018_country = sort_and_rename(stats_2018_country, zone_type='Country')
-diff_country = sort_and_rename(diff_country, zone_type='Country')
-
-stats_2012_nuts2 = sort_and_rename(stats_2012_nuts2, zone_type='Region')
-stats_2018_nuts2 = sort_and_rename(stats_2018_nuts2, zone_type='Region')
-diff_nuts2 = sort_and_rename(diff_nuts2, zone_type='Region')
-
-# Add total rows and columns
-stats_2012_country = add_totals(stats_2012_country)
-stats_2018_country = add_totals(stats_2018_country)
-diff_country = add_totals(diff_country)
-
-stats_2012_nuts2 = add_totals(stats_2012_nuts2)
-stats_2018_nuts2 = add_totals(stats_2018_nuts2)
-diff_nuts2 = add_totals(diff_nuts2)
-
-# ---- NEW: Add share columns (percentage share of each ecosystem) for 2012 and 2018 stats ----
-stats_2012_country = add_share_columns(stats_2012_country)
-stats_2018_country = add_share_columns(stats_2018_country)
-stats_2012_nuts2 = add_share_columns(stats_2012_nuts2)
-stats_2018_nuts2 = add_share_columns(stats_2018_nuts2)
-
-# ----- Export results to an Excel workbook -----
-output_excel = "ecosystem_areas_comparison.xlsx"
-with pd.ExcelWriter(output_excel) as writer:
-    stats_2012_country.to_excel(writer, sheet_name="Country_2012", index=False)
-    stats_2018_country.to_excel(writer, sheet_name="Country_2018", index=False)
-    diff_country.to_excel(writer, sheet_name="Country_Diff", index=False)
-    stats_2012_nuts2.to_excel(writer, sheet_name="NUTS2_2012", index=False)
-    stats_2018_nuts2.to_excel(writer, sheet_name="NUTS2_2018", index=False)
-    diff_nuts2.to_excel(writer, sheet_name="NUTS2_Diff", index=False)
+def name_transitions(df):
+    # Replace class codes with ecosystem names (class 0 is nodata) and sort by zone and area
+    names = {0: 'No data', **ecosystem_classes}
+    df = df.assign(From=df['From'].map(lambda k: names.get(int(k), k)),
+                   To=df['To'].map(lambda k: names.get(int(k), k)))
+    return df.sort_values(['Zone', 'Area'], ascending=[True, False])
 
-def export_geojson(geojson_input, df, output_file, zone_type='NUTS0'):
+def load_zone_boundaries(geojson_input, zone_type='NUTS0'):
+    """Reads a boundary file once and adds the 'Zone' join key used by the accounts tables."""
     gdf = gpd.read_file(geojson_input)
 
     if zone_type == 'NUTS0':
         gdf['Zone'] = gdf['NUTS_NAME']
-    elif zone_type == 'NUTS2':
+    elif zone_type in ('NUTS1', 'NUTS2', 'NUTS3'):
         gdf['Zone'] = gdf['CNTR_CODE'] + '_' + gdf['NUTS_NAME']
+    return gdf
 
+def export_attributes(df):
     # Remove total row
     df = df[df['Zone'] != 'Total']
 
     # Optionally drop 'Total' column if present
     if 'Total' in df.columns:
         df = df.drop(columns=['Total'])
+    return df
+
+def export_geojson(geojson_input, df, output_file, zone_type='NUTS0'):
+    # geojson_input can also be a GeoDataFrame from load_zone_boundaries (no re-read)
+    if isinstance(geojson_input, gpd.GeoDataFrame):
+        gdf = geojson_input
+    else:
+        gdf = load_zone_boundaries(geojson_input, zone_type=zone_type)
 
     # Merge attributes
-    gdf = gdf.merge(df, on='Zone', how='left')
+    gdf = gdf.merge(export_attributes(df), on='Zone', how='left')
 
     gdf.to_file(output_file, driver='GeoJSON')
 
-export_geojson(nuts0_file, stats_2012_country, 'Country_2012.geojson', zone_type='NUTS0')
-export_geojson(nuts0_file, stats_2018_country, 'Country_2018.geojson', zone_type='NUTS0')
-export_geojson(nuts0_file, diff_country, '2018_2012_Country_Diff.geojson', zone_type='NUTS0')
+def export_zone_layers(boundaries, tables, output_stem, formats=('parquet',), geojson_files=None):
+    """
+    Joins all tables of one boundary set in memory and writes them as a single layer.
+
+    boundaries: GeoDataFrame from load_zone_boundaries (each boundary file is read once).
+    tables:     {name: export table}, e.g. {'2012': ..., '2018': ..., 'Diff': ...}; in the joined layer
+                columns get a ' {name}' suffix unless they already end with it (diff columns).
+    formats:    'parquet' -> {output_stem}.parquet (GeoParquet), 'fgb' -> {output_stem}.fgb (FlatGeobuf),
+                'geojson' -> one GeoJSON per table as written by export_geojson
+                (geojson_files[name], default {output_stem}_{name}.geojson).
+    The joined attributes are also written without geometry to {output_stem}_attributes.parquet, so
+    consumers can read the numbers without parsing geometries.
+    """
+    layer = boundaries
+    for name, df in tables.items():
+        attrs = export_attributes(df).drop(columns=['Country', 'Region'], errors='ignore')
+        suffix = f' {name}'
+        attrs = attrs.rename(columns={col: col if col == 'Zone' or col.endswith(suffix) else col + suffix
+                                      for col in attrs.columns})
+        layer = layer.merge(attrs, on='Zone', how='left')
+
+    written = []
+    if 'parquet' in formats:
+        layer.to_parquet(f'{output_stem}.parquet')
+        written.append(f'{output_stem}.parquet')
+    if 'fgb' in formats:
+        layer.to_file(f'{output_stem}.fgb', driver='FlatGeobuf')
+        written.append(f'{output_stem}.fgb')
+    if 'geojson' in formats:
+        geojson_files = geojson_files or {}
+        for name, df in tables.items():
+            output_file = geojson_files.get(name, f'{output_stem}_{name}.geojson')
+            export_geojson(boundaries, df, output_file)
+            written.append(output_file)
+
+    pd.DataFrame(layer.drop(columns=layer.geometry.name)).to_parquet(f'{output_stem}_attributes.parquet')
+    written.append(f'{output_stem}_attributes.parquet')
+    return written
+
+# ----- Pipeline steps -----
+# Each step takes the results of the steps it depends on (in 'depends' order); see pipeline_steps().
+
+def step_reclassify():
+    if run_reclassify_benchmark:
+        benchmark_reclassify_engines(raster_2012_input)
+
+    print("Reclassifying rasters to level1 and level2 ...")
+    reclassify_rasters_parallel([
+        (raster_2012_input, {'level1': raster_2012_output, 'level2': raster_2012_level2_output}),
+        (raster_2018_input, {'level1': raster_2018_output, 'level2': raster_2018_level2_output}),
+    ], workers=reclassify_workers, max_memory_mb=reclassify_max_memory_mb,
+        output_format=reclassify_output_format, codec=reclassify_codec)
+    return {'2012': raster_2012_output, '2018': raster_2018_output}
+
+def step_zonal(reclassify):
+    """Accounts are kept as ZoneAccounts (zones x classes pixel counts) and only turned into tables at export."""
+    if change_accounts:
+        print(f"Computing change accounts at {finest_level} and rolling up ...")
+        accounts = compute_change_accounts_hierarchy(reclassify['2012'], reclassify['2018'], nuts_files,
+                                                     finest_level=finest_level, zone_cache_dir=zone_cache_dir,
+                                                     as_accounts=True)
+        return {level: {'2012': stats_from, '2018': stats_to, 'transitions': transitions}
+                for level, (stats_from, stats_to, _, transitions) in accounts.items()}
+
+    print(f"Computing zonal statistics at {finest_level} and rolling up ...")
+    accounts_2012 = compute_zonal_stats_hierarchy(reclassify['2012'], nuts_files, finest_level=finest_level,
+                                                  engine=zonal_engine, zone_cache_dir=zone_cache_dir,
+                                                  as_accounts=True)
+    accounts_2018 = compute_zonal_stats_hierarchy(reclassify['2018'], nuts_files, finest_level=finest_level,
+                                                  engine=zonal_engine, zone_cache_dir=zone_cache_dir,
+                                                  as_accounts=True)
+    return {level: {'2012': accounts_2012[level], '2018': accounts_2018[level], 'transitions': None}
+            for level in nuts_files}
+
+def step_diff(zonal):
+    return {level: accounts['2018'] - accounts['2012'] for level, accounts in zonal.items()}
+
+def step_format(zonal, diff):
+    # Build the export tables (sorted, renamed, with totals, and shares for the yearly stats)
+    tables = {}
+    for level, accounts in zonal.items():
+        tables[level] = {
+            '2012': accounts['2012'].to_table(),
+            '2018': accounts['2018'].to_table(),
+            'Diff': diff[level].to_table(),
+            'Transitions': name_transitions(accounts['transitions']) if accounts['transitions'] is not None else None,
+        }
+
+    # ----- Export results to an Excel workbook -----
+    sheet_prefix = {'NUTS0': 'Country'}
+    with pd.ExcelWriter(output_excel) as writer:
+        for level, level_tables in tables.items():
+            prefix = sheet_prefix.get(level, level)
+            for name, df in level_tables.items():
+                if df is not None:
+                    df.to_excel(writer, sheet_name=f"{prefix}_{name}", index=False)
+    return tables
+
+def step_export(tables):
+    written = []
+    country_boundaries = load_zone_boundaries(nuts0_file, zone_type='NUTS0')
+    country = tables['NUTS0']
+    written += export_zone_layers(country_boundaries, {'2012': country['2012'], '2018': country['2018'],
+                                                       'Diff': country['Diff']},
+                                  'Country', formats=export_formats,
+                                  geojson_files={'2012': 'Country_2012.geojson', '2018': 'Country_2018.geojson',
+                                                 'Diff': '2018_2012_Country_Diff.geojson'})
+
+    nuts2_boundaries = load_zone_boundaries(nuts2_file, zone_type='NUTS2')
+    nuts2 = tables['NUTS2']
+    written += export_zone_layers(nuts2_boundaries, {'2012': nuts2['2012'], '2018': nuts2['2018'],
+                                                     'Diff': nuts2['Diff']},
+                                  'NUTS2', formats=export_formats,
+                                  geojson_files={'2012': 'NUTS2_2012.geojson', '2018': 'NUTS2_2018.geojson',
+                                                 'Diff': '2018_2012_NUTS2_Diff.geojson'})
+    return written
+
+def pipeline_steps():
+    """
+    Step specs in run order: the function, the functions and classes it calls (their code goes into
+    the cache key, so an edit only reruns the steps that use it), the steps it depends on, the files
+    it reads, the settings that change its result, and the files it writes (checked on every cache hit).
+    """
+    layer_stems = ['Country', 'NUTS2']
+    export_outputs = [f'{stem}_attributes.parquet' for stem in layer_stems]
+    if 'parquet' in export_formats:
+        export_outputs += [f'{stem}.parquet' for stem in layer_stems]
+    if 'fgb' in export_formats:
+        export_outputs += [f'{stem}.fgb' for stem in layer_stems]
+    if 'geojson' in export_formats:
+        export_outputs += ['Country_2012.geojson', 'Country_2018.geojson', '2018_2012_Country_Diff.geojson',
+                           'NUTS2_2012.geojson', 'NUTS2_2018.geojson', '2018_2012_NUTS2_Diff.geojson']
+    return [
+        {'name': 'reclassify', 'func': step_reclassify, 'depends': [],
+         'calls': [reclassify_rasters_parallel, _check_reclassify_args, _open_reclassify_outputs,
+                   _reclassify_profile, _reclassify_batch, _reclassify_block, build_lookup_table,
+                   reclassify_block_lut, reclassify_block_mask, _finish_cog_outputs,
+                   _remove_cog_intermediates, write_cog, benchmark_reclassify_engines],
+         'inputs': [raster_2012_input, raster_2018_input],
+         'params': {'mapping': sorted(clc_to_ecosystem.items()), 'output_format': reclassify_output_format,
+                    'codec': reclassify_codec},
+         'outputs': [raster_2012_output, raster_2018_output, raster_2012_level2_output, raster_2018_level2_output]},
+        {'name': 'zonal', 'func': step_zonal, 'depends': ['reclassify'],
+         'calls': [ZoneAccounts, compute_zonal_stats_hierarchy, compute_change_accounts_hierarchy,
+                   compute_zonal_stats, compute_zonal_stats_bincount, compute_zone_class_counts,
+                   compute_transition_counts, change_accounts_from_counts, accumulate_zone_class_counts,
+                   accumulate_transition_counts, zone_counts_to_dataframe, transitions_to_dataframe,
+                   rollup_zone_counts, _rollup_levels, nuts_zone_table, iter_zone_blocks, iter_chunk_windows,
+                   burn_zone_block, get_zone_ids, get_zone_name, zone_id_dtype, ensure_numeric,
+                   get_zone_raster, write_zone_raster, zone_cache_key, _file_sha256,
+                   _load_zone_cache_index, _save_zone_cache_index, _evict_zone_cache],
+         'inputs': list(nuts_files.values()),
+         'params': {'engine': zonal_engine, 'finest_level': finest_level, 'levels': sorted(nuts_files),
+                    'change_accounts': change_accounts},
+         'outputs': []},
+        {'name': 'diff', 'func': step_diff, 'depends': ['zonal'], 'calls': [ZoneAccounts],
+         'inputs': [], 'params': {}, 'outputs': []},
+        {'name': 'format', 'func': step_format, 'depends': ['zonal', 'diff'],
+         'calls': [ZoneAccounts, name_transitions], 'inputs': [],
+         'params': {'classes': sorted(ecosystem_classes.items()), 'output_excel': output_excel},
+         'outputs': [output_excel]},
+        {'name': 'export', 'func': step_export, 'depends': ['format'],
+         'calls': [load_zone_boundaries, export_zone_layers, export_attributes, export_geojson],
+         'inputs': [nuts0_file, nuts2_file],
+         'params': {'formats': list(export_formats)}, 'outputs': export_outputs},
+    ]
+
+# ----- Content-addressed step cache -----
+
+def file_fingerprint(path, hash_limit=64 * 1024 * 1024):
+    """
+    sha256 of the file contents for files up to hash_limit bytes; larger files (the multi-GB CORINE
+    rasters) are identified by size and mtime, as hashing them would cost a full read per run.
+    """
+    import os
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    if stat.st_size > hash_limit:
+        return f'size={stat.st_size},mtime={stat.st_mtime_ns}'
+    return _file_sha256(path)
+
+def step_cache_key(step, upstream_keys):
+    """
+    Hash of the step's code (the step function and everything in its 'calls'), input files,
+    parameters and the keys of the steps it depends on.
+    """
+    import hashlib
+    import inspect
+    import json
+    payload = {
+        'step': step['name'],
+        'code': {obj.__qualname__: hashlib.sha256(inspect.getsource(obj).encode()).hexdigest()
+                 for obj in [step['func'], *step['calls']]},
+        'inputs': {path: file_fingerprint(path) for path in step['inputs']},
+        'params': step['params'],
+        'depends': [upstream_keys[name] for name in step['depends']],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:24]
+
+def _load_step_cache(cache_dir, name, key):
+    import os
+    import pickle
+    path = os.path.join(cache_dir, f'{name}-{key}.pkl')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        entry = pickle.load(f)
+    # Output files must still be the ones this entry wrote
+    if any(file_fingerprint(out) != fingerprint for out, fingerprint in entry['outputs'].items()):
+        return None
+    return entry
+
+def _save_step_cache(cache_dir, name, key, result, outputs):
+    import os
+    import pickle
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'{name}-{key}.pkl')
+    entry = {'result': result, 'outputs': {out: file_fingerprint(out) for out in outputs}}
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(entry, f)
+    os.replace(path + '.tmp', path)
+
+def run_pipeline(steps, selected=None, force=(), cache_dir=pipeline_cache_dir, use_cache=True):
+    """
+    Runs the steps in order. A step whose key (see step_cache_key) has a cache entry with unchanged
+    output files is skipped and its result loaded. Steps in `force` always run. When `selected` is
+    given only those steps run; the others are taken from the cache when it has them and skipped
+    otherwise, which is only an error if a selected step needs their result.
+    Returns ({step: result}, [(step, status, seconds)]).
+    """
+    import time
+
+    results, keys, report = {}, {}, []
+    for step in steps:
+        name = step['name']
+        t0 = time.perf_counter()
+        keys[name] = step_cache_key(step, keys)
+        entry = None
+        if use_cache and name not in force:
+            entry = _load_step_cache(cache_dir, name, keys[name])
+        missing = [dep for dep in step['depends'] if dep not in results]
+        if entry is not None:
+            results[name] = entry['result']
+            status = 'cache hit'
+        elif selected is not None and name not in selected:
+            status = 'skipped'
+        elif missing:
+            raise SystemExit(f"Step '{name}' needs {', '.join(missing)}, which is not selected and has no "
+                             f"valid cache entry; add it to --steps or run it first.")
+        else:
+            results[name] = step['func'](*[results[dep] for dep in step['depends']])
+            _save_step_cache(cache_dir, name, keys[name], results[name], step['outputs'])
+            status = 'forced' if name in force else 'run'
+        report.append((name, status, time.perf_counter() - t0))
+        print(f"[{name}] {status} in {report[-1][2]:.1f}s")
+    return results, report
+
+def main(argv=None):
+    import argparse
+
+    step_names = [step['name'] for step in pipeline_steps()]
+    parser = argparse.ArgumentParser(description="Ecosystem extent accounts from CORINE land cover")
+    parser.add_argument("--steps", nargs='+', choices=step_names,
+                        help="Run only these steps, the others are taken from the cache")
+    parser.add_argument("--force", nargs='+', choices=step_names + ['all'], default=[],
+                        help="Rerun these steps even if their cache entry is valid")
+    parser.add_argument("--no-cache", action='store_true', help="Ignore the step cache (everything runs)")
+    parser.add_argument("--cache-dir", default=pipeline_cache_dir, help="Step cache directory")
+    args = parser.parse_args(argv)
+
+    force = set(step_names) if 'all' in args.force else set(args.force)
+    results, report = run_pipeline(pipeline_steps(), selected=args.steps, force=force,
+                                   cache_dir=args.cache_dir, use_cache=not args.no_cache)
 
-export_geojson(nuts2_file, stats_2012_nuts2, 'NUTS2_2012.geojson', zone_type='NUTS2')
-export_geojson(nuts2_file, stats_2018_nuts2, 'NUTS2_2018.geojson', zone_type='NUTS2')
-export_geojson(nuts2_file, diff_nuts2, '2018_2012_NUTS2_Diff.geojson', zone_type='NUTS2')
+    print("\nStep timings:")
+    for name, status, seconds in report:
+        print(f"  {name:<12}{status:<12}{seconds:8.1f}s")
+    print("Processing complete. New TIFF files, Excel report, and zone layers with share columns generated.")
+    return results
 
-print("Processing complete. New TIFF files, Excel report, and GeoJSON outputs with share columns generated.")
+if __name__ == '__main__':
+    main()
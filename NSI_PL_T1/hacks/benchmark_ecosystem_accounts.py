@@ -0,0 +1,302 @@
+"""
+Benchmark suite for MEA_CULPA_Ecosystem_accounts.py on synthetic data.
+
+Generates CLC-coded rasters of configurable size and block layout and nested NUTS0/NUTS2 polygon
+sets (few large zones, many small zones, jagged coastlines with islands), then times every stage
+in a fresh process and reports Mpixel/s, peak RSS and bytes read. The bincount engines are checked
+for exact counts against a brute-force reference (full-grid rasterization of every polygon); region
+edges are snapped to the pixel grid, so every pixel belongs to at most one polygon.
+
+Run from this directory, e.g.:
+    python benchmark_ecosystem_accounts.py --width 8000 --height 6000 --block 512 --zones all
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.features import rasterize
+from shapely.geometry import box, Polygon
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import MEA_CULPA_Ecosystem_accounts as ea
+
+pixel_size = 100  # metres, as the 100 m CORINE mosaic
+origin = (4000000, 3500000)  # upper left corner in EPSG:3035
+clc_nodata = 128
+# Mapped CORINE codes plus codes without an ecosystem (33, 44) and the CLC "no data" code 48
+clc_codes = np.array(sorted(ea.clc_to_ecosystem) + [33, 44, 48])
+
+zone_sets = ['few_large', 'many_small', 'jagged']
+stages = ['reclassify_mask', 'reclassify_lut', 'reclassify_parallel', 'reclassify_cog',
+          'zonal_polygon', 'zonal_bincount', 'zonal_bincount_cached', 'change_accounts']
+
+# ----- Synthetic data -----
+
+def write_synthetic_clc(path, width, height, block=256, seed=0, change_fraction=0.0, base_seed=None):
+    """
+    Writes a CLC-coded uint8 raster: patches of 64x64 px with one class plus 10% per-pixel noise and
+    ~10% nodata "sea" patches. block > 0 writes a tiled GeoTIFF with block x block tiles, block = 0 a
+    striped one. With change_fraction and base_seed the raster is the base_seed raster with that
+    fraction of pixels changed (a second "year").
+    """
+    patch = 64
+    coarse_rng = np.random.default_rng(seed if base_seed is None else base_seed)
+    coarse = coarse_rng.choice(clc_codes, size=(-(-height // patch), -(-width // patch))).astype(np.uint8)
+    coarse[coarse_rng.random(coarse.shape) < 0.1] = clc_nodata
+
+    profile = {'driver': 'GTiff', 'dtype': 'uint8', 'count': 1, 'width': width, 'height': height,
+               'crs': 'EPSG:3035', 'transform': from_origin(origin[0], origin[1], pixel_size, pixel_size),
+               'nodata': clc_nodata, 'compress': 'lzw'}
+    if block:
+        profile.update(tiled=True, blockxsize=block, blockysize=block)
+    with rasterio.open(path, 'w', **profile) as dst:
+        for window in ea.iter_chunk_windows(width, height, 1024):
+            rows = np.arange(window.row_off, window.row_off + window.height) // patch
+            cols = np.arange(window.col_off, window.col_off + window.width) // patch
+            data = coarse[np.ix_(rows, cols)]
+            # Noise depends on the base seed and the window only, so a changed year differs exactly
+            # where the change mask says so
+            noise_rng = np.random.default_rng([seed if base_seed is None else base_seed,
+                                               window.row_off, window.col_off])
+            noise = noise_rng.random(data.shape) < 0.1
+            data = np.where(noise & (data != clc_nodata), noise_rng.choice(clc_codes, size=data.shape), data)
+            if change_fraction:
+                change_rng = np.random.default_rng([seed, window.row_off, window.col_off])
+                changed = change_rng.random(data.shape) < change_fraction
+                data = np.where(changed, change_rng.choice(clc_codes, size=data.shape), data)
+            dst.write(data.astype(np.uint8), 1, window=window)
+    return path
+
+def _country_code(i):
+    return chr(65 + i // 26) + chr(65 + i % 26)
+
+def _jagged_land(bounds, seed, n_vertices=4000, n_islands=40):
+    """A coastline-like land polygon (radial noise on an ellipse) plus small islands."""
+    from shapely.ops import unary_union
+
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    cx, cy = (minx + maxx) / 2, (miny + maxy) / 2
+    rx, ry = (maxx - minx) * 0.45, (maxy - miny) * 0.45
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    # Sum of random-phase harmonics gives a rough, self-similar coast
+    radius = np.ones(n_vertices)
+    for k in (3, 7, 17, 41, 97, 211, 499):
+        radius += rng.normal(0, 0.6 / k ** 0.7) * np.sin(k * angles + rng.uniform(0, 2 * np.pi))
+    radius = np.clip(radius, 0.3, 1.1)
+    parts = [Polygon(np.column_stack([cx + rx * radius * np.cos(angles), cy + ry * radius * np.sin(angles)])).buffer(0)]
+    for _ in range(n_islands):
+        ix, iy = rng.uniform(minx, maxx), rng.uniform(miny, maxy)
+        size = rng.uniform(2, 20) * pixel_size
+        a = np.linspace(0, 2 * np.pi, 24, endpoint=False)
+        r = size * rng.uniform(0.5, 1.0, a.size)
+        parts.append(Polygon(np.column_stack([ix + r * np.cos(a), iy + r * np.sin(a)])).buffer(0))
+    return unary_union(parts)
+
+def synthetic_nuts(kind, width, height, seed=0):
+    """
+    NUTS2 GeoDataFrame covering the synthetic raster with NUTS_ID, CNTR_CODE and NUTS_NAME fields.
+    Regions are grid cells with edges on pixel boundaries, grouped into countries by CNTR_CODE.
+    kind: 'few_large' (2x2 countries of 2x2 regions), 'many_small' (5x5 countries of 8x8 regions)
+          or 'jagged' (4x3 countries of 3x3 regions clipped to a jagged coastline with islands).
+    """
+    minx, maxy = origin
+    maxx, miny = minx + width * pixel_size, maxy - height * pixel_size
+    layout = {'few_large': ((2, 2), (2, 2)), 'many_small': ((5, 5), (8, 8)), 'jagged': ((4, 3), (3, 3))}
+    (ncx, ncy), (nrx, nry) = layout[kind]
+    nx, ny = ncx * nrx, ncy * nry
+    # Cell edges on whole pixels: a linspace edge inside a pixel would put its centre in two
+    # regions' brute-force masks, while the zone raster assigns it to one
+    xs = minx + np.round(np.linspace(0, width, nx + 1)) * pixel_size
+    ys = miny + np.round(np.linspace(0, height, ny + 1)) * pixel_size
+    land = _jagged_land((minx, miny, maxx, maxy), seed) if kind == 'jagged' else None
+
+    regions = []
+    for i in range(nx):
+        for j in range(ny):
+            cntr = _country_code((i // nrx) * ncy + j // nry)
+            geom = box(xs[i], ys[j], xs[i + 1], ys[j + 1])
+            if land is not None:
+                geom = geom.intersection(land)
+                if geom.is_empty:
+                    continue
+            k = (i % nrx) * nry + j % nry
+            regions.append({'NUTS_ID': f'{cntr}{k:02d}', 'CNTR_CODE': cntr,
+                            'NUTS_NAME': f'Region {cntr}{k:02d}', 'geometry': geom})
+    return gpd.GeoDataFrame(regions, crs='EPSG:3035')
+
+def brute_force_counts(raster_file, gdf):
+    """Reference (zone, class) counts: every polygon rasterized on the full grid, np.unique per zone."""
+    with rasterio.open(raster_file) as src:
+        data = src.read(1)
+        nodata = src.nodata if src.nodata is not None else 0
+        gdf = gdf.to_crs(src.crs) if gdf.crs != src.crs else gdf
+        counts = {}
+        for i, geom in enumerate(gdf.geometry):
+            mask = rasterize([(geom, 1)], out_shape=data.shape, transform=src.transform, fill=0, dtype='uint8')
+            values = data[(mask == 1) & (data != nodata)]
+            unique, n = np.unique(values, return_counts=True)
+            counts[i] = dict(zip(unique.tolist(), n.tolist()))
+    return counts
+
+def check_zonal_counts(raster_file, geojson_file, zone_type, zone_cache_dir):
+    """Compares the bincount engine (plain and cached) with the brute-force reference, exact counts."""
+    gdf = gpd.read_file(geojson_file)
+    reference = brute_force_counts(raster_file, gdf)
+    results = {}
+    for name, cache_dir in (('bincount', None), ('bincount_cached', zone_cache_dir)):
+        counts = ea.compute_zone_class_counts(raster_file, geojson_file, zone_type, zone_cache_dir=cache_dir)[0]
+        mismatches = 0
+        for i, expected in reference.items():
+            found = {k: int(v) for k, v in enumerate(counts[i + 1]) if v}
+            mismatches += found != expected
+        results[name] = mismatches
+    return results
+
+# ----- Stage runner -----
+
+def _read_bytes():
+    """Bytes read by this process through read syscalls (Linux /proc/self/io), None elsewhere."""
+    try:
+        with open('/proc/self/io') as f:
+            return int(next(line for line in f if line.startswith('rchar:')).split()[1])
+    except (OSError, StopIteration):
+        return None
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS of this process to its current RSS (Linux). A spawned worker otherwise
+    starts with the high-water mark of its parent, which ru_maxrss keeps across fork and exec.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _peak_rss_mb():
+    """Peak RSS since _reset_peak_rss (VmHWM on Linux), else ru_maxrss of the whole process."""
+    try:
+        with open('/proc/self/status') as f:
+            return int(next(line for line in f if line.startswith('VmHWM:')).split()[1]) / 1024
+    except (OSError, StopIteration):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def _stage(stage, workdir, raster_file, raster_file_2, geojson_file, zone_type):
+    """Runs one stage; called in a fresh process so peak RSS and bytes read belong to this stage only."""
+    out = os.path.join(workdir, f'out_{stage}.tif')
+    cache_dir = os.path.join(workdir, 'zone_cache')
+    _reset_peak_rss()
+    read_before, t0 = _read_bytes(), time.perf_counter()
+    if stage == 'reclassify_mask':
+        ea.reclassify_raster_levels(raster_file, out, engine='mask')
+    elif stage == 'reclassify_lut':
+        ea.reclassify_raster_levels(raster_file, out, engine='lut')
+    elif stage == 'reclassify_parallel':
+        ea.reclassify_raster_levels(raster_file, out, engine='lut', workers=os.cpu_count() or 4)
+    elif stage == 'reclassify_cog':
+        ea.reclassify_raster_levels(raster_file, out, engine='lut', output_format='cog')
+    elif stage == 'zonal_polygon':
+        ea.compute_zonal_stats(raster_file, geojson_file, zone_type=zone_type, engine='polygon')
+    elif stage == 'zonal_bincount':
+        ea.compute_zonal_stats(raster_file, geojson_file, zone_type=zone_type, engine='bincount')
+    elif stage == 'zonal_bincount_cached':
+        ea.compute_zonal_stats(raster_file, geojson_file, zone_type=zone_type, engine='bincount',
+                               zone_cache_dir=cache_dir)
+    elif stage == 'change_accounts':
+        ea.compute_change_accounts(raster_file, raster_file_2, geojson_file, zone_type=zone_type,
+                                   zone_cache_dir=cache_dir)
+    seconds = time.perf_counter() - t0
+    read_after = _read_bytes()
+    return {'seconds': seconds, 'peak_rss_mb': _peak_rss_mb(),
+            'bytes_read': read_after - read_before if read_before is not None else None}
+
+def run_stage(stage, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(_stage, stage, *args).result()
+
+def run_benchmark(workdir, width, height, block, zones, selected_stages):
+    os.makedirs(workdir, exist_ok=True)
+    n_pixels = width * height
+    raster = os.path.join(workdir, f'clc_{width}x{height}_b{block}_2012.tif')
+    raster_2 = os.path.join(workdir, f'clc_{width}x{height}_b{block}_2018.tif')
+    print(f"Generating {width}x{height} synthetic CLC rasters (block {block or 'striped'}) ...")
+    write_synthetic_clc(raster, width, height, block, seed=0)
+    write_synthetic_clc(raster_2, width, height, block, seed=1, change_fraction=0.05, base_seed=0)
+
+    # Zonal stages run on reclassified (level1) rasters, as in the accounts script
+    level1, level1_2 = (os.path.join(workdir, f'level1_{year}.tif') for year in (2012, 2018))
+    ea.reclassify_raster_levels(raster, level1, levels=('level1',))
+    ea.reclassify_raster_levels(raster_2, level1_2, levels=('level1',))
+
+    rows = []
+    reclassified = []
+    for stage in [s for s in stages if s.startswith('reclassify') and s in selected_stages]:
+        rows.append({'stage': stage, 'zones': '-', 'n_zones': 0, **run_stage(stage, workdir, raster, None, None, None)})
+        reclassified.append(os.path.join(workdir, f'out_{stage}.tif'))
+    if len(reclassified) > 1:
+        with rasterio.open(reclassified[0]) as ref:
+            expected = ref.read()
+        for path in reclassified[1:]:
+            with rasterio.open(path) as src:
+                if not np.array_equal(src.read(), expected):
+                    raise AssertionError(f"{path} differs from {reclassified[0]}")
+        print(f"Reclassification outputs identical across {len(reclassified)} engines")
+        with pd.option_context('display.width', 200, 'display.max_columns', 20):
+            print(ea.raster_output_report(reclassified).round(3).to_string(index=False))
+
+    for kind in zones:
+        nuts2 = synthetic_nuts(kind, width, height)
+        geojson_file = os.path.join(workdir, f'nuts2_{kind}.geojson')
+        nuts2.to_file(geojson_file, driver='GeoJSON')
+        cache_dir = os.path.join(workdir, 'zone_cache')
+        if os.path.isdir(cache_dir):
+            ea.invalidate_zone_cache(cache_dir)
+        # Warm the zone raster cache, so 'zonal_bincount_cached' measures the repeat-run case
+        ea.get_zone_raster(geojson_file, 'NUTS2', level1, cache_dir)
+        for stage in [s for s in stages if not s.startswith('reclassify') and s in selected_stages]:
+            rows.append({'stage': stage, 'zones': kind, 'n_zones': len(nuts2),
+                         **run_stage(stage, workdir, level1, level1_2, geojson_file, 'NUTS2')})
+        check = check_zonal_counts(level1, geojson_file, 'NUTS2', cache_dir)
+        print(f"Exact-count check ({kind}, {len(nuts2)} zones): " +
+              ", ".join(f"{name}: {'OK' if n == 0 else f'{n} zones differ'}" for name, n in check.items()))
+        if any(check.values()):
+            raise AssertionError(f"bincount engine counts differ from the brute-force reference ({kind})")
+
+    report = pd.DataFrame(rows)
+    report['mpix_per_s'] = n_pixels / report['seconds'] / 1e6
+    report['mb_read'] = report['bytes_read'] / 1024 / 1024
+    return report.drop(columns=['bytes_read'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ecosystem accounts stages on synthetic data")
+    parser.add_argument("--width", type=int, default=4000, help="Raster width in pixels")
+    parser.add_argument("--height", type=int, default=3000, help="Raster height in pixels")
+    parser.add_argument("--block", type=int, default=256, help="Tile size of the input raster, 0 for striped")
+    parser.add_argument("--zones", nargs='+', choices=zone_sets + ['all'], default=['all'], help="Polygon sets")
+    parser.add_argument("--stages", nargs='+', choices=stages, default=stages, help="Stages to time")
+    parser.add_argument("--workdir", default="benchmark_data", help="Directory for the synthetic data")
+    parser.add_argument("--json", help="Also write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    zones = zone_sets if 'all' in args.zones else args.zones
+    report = run_benchmark(args.workdir, args.width, args.height, args.block, zones, args.stages)
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        print(report.round(2).to_string(index=False))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report.to_dict(orient='records'), f, indent=1)
+    return report
+
+if __name__ == '__main__':
+    main()
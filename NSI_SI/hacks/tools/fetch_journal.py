@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Alen Mangafić
+"""
+import os
+import pickle
+import sqlite3
+from datetime import datetime, timezone
+
+# Journal of the (year, tile, band) outputs of s2_fetch.py. Only the main process writes to it (the
+# warp workers return their results), and every status change is one SQLite transaction, so a crash
+# loses nothing that finished.
+IN_PROGRESS, DONE, FAILED = "in_progress", "done", "failed"
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+class FetchJournal:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                year INTEGER, tile TEXT, band TEXT, status TEXT, output TEXT, started TEXT, finished TEXT,
+                attempts INTEGER DEFAULT 0, error TEXT, PRIMARY KEY (year, tile, band))""")
+
+    def close(self):
+        self.db.close()
+
+    def _execute(self, sql, params=()):
+        return self.db.execute(sql, params).fetchall()
+
+    def status(self, year, tile, band):
+        rows = self._execute("SELECT status FROM jobs WHERE year = ? AND tile = ? AND band = ?", (year, tile, band))
+        return rows[0][0] if rows else None
+
+    def start(self, year, tile, band, output=None):
+        """Marks a job in progress; False if it is already done."""
+        # check and update in one write transaction, in case another run shares the journal file
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT status FROM jobs WHERE year = ? AND tile = ? AND band = ?",
+                                  (year, tile, band)).fetchone()
+            if row and row[0] == DONE:
+                return False
+            self.db.execute("""
+                INSERT INTO jobs (year, tile, band, status, output, started, attempts) VALUES (?, ?, ?, ?, ?, ?, 1)
+                ON CONFLICT (year, tile, band) DO UPDATE SET status = excluded.status, output = excluded.output,
+                    started = excluded.started, finished = NULL, error = NULL, attempts = attempts + 1""",
+                            (year, tile, band, IN_PROGRESS, output, _now()))
+        finally:
+            self.db.execute("COMMIT")
+        return True
+
+    def done(self, year, tile, band, output=None):
+        self._execute("""
+            INSERT INTO jobs (year, tile, band, status, output, finished) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (year, tile, band) DO UPDATE SET status = excluded.status, finished = excluded.finished,
+                output = COALESCE(excluded.output, output), error = NULL""",
+                      (year, tile, band, DONE, output, _now()))
+
+    def failed(self, year, tile, band, error):
+        self._execute("UPDATE jobs SET status = ?, finished = ?, error = ? WHERE year = ? AND tile = ? AND band = ?",
+                      (FAILED, _now(), str(error), year, tile, band))
+
+    def recover(self):
+        """
+        Jobs left in progress by an interrupted run are marked failed and their partial outputs
+        removed, so they are redone; returns how many there were.
+        """
+        rows = self._execute("SELECT year, tile, band, output FROM jobs WHERE status = ?", (IN_PROGRESS,))
+        for year, tile, band, output in rows:
+            for path in (output, f"{output}.part") if output else ():
+                if os.path.exists(path):
+                    os.remove(path)
+            self.failed(year, tile, band, "interrupted")
+        return len(rows)
+
+    def import_pickle(self, path):
+        """Takes over the (year, tile, band) set of an old processed_tiles.pkl as done jobs."""
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'rb') as f:
+            processed = pickle.load(f)
+        for year, tile, band in processed:
+            if self.status(year, tile, band) is None:
+                self.done(year, tile, band)
+        return len(processed)
+
+    def summary(self):
+        return dict(self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def jobs(self, status=None):
+        if status is None:
+            return self._execute("SELECT year, tile, band, status, attempts, error FROM jobs ORDER BY year, tile, band")
+        return self._execute("SELECT year, tile, band, status, attempts, error FROM jobs WHERE status = ? ORDER BY year, tile, band", (status,))
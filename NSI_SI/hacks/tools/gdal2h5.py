@@ -4,6 +4,12 @@
 @author: Alen Mangafić
 """
 import os
+import json
+import time
+import zlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import h5py
 import rasterio
 import numpy as np
@@ -11,11 +17,38 @@ from rasterio.windows import Window
 
 # Paths
 bands_directory = "/path/to/s2/vrt"
+# vrt_manifest.json written by s2bands_to_yearly_vrt.py: ingest exactly the VRTs it lists (None:
+# every .vrt in bands_directory)
+vrt_manifest = os.path.join(bands_directory, "vrt_manifest.json")
 label_file = "/path/to/classification/S2GLC_Europe_2017_clipped_20m.tif"
 output_h5 = "/path/to/wherever/ard.h5"
 
+# "gzip", "lzf" or "blosc-zstd" (needs hdf5plugin, also on the reading side)
 compression_type = "gzip"
-tile_size = 256  
+compression_level = 4
+tile_size = 256
+
+# Feature storage: "float32" (0 -> NaN, as before), "uint16" (raw digital numbers, 0 declared as
+# nodata) or "float16" (values divided by float16_scale, 0 -> NaN). The nodata/scale_factor
+# attributes tell the readers (unet_mini/h5_tiles.py) how to get float32 with NaN back.
+feature_dtype = "float32"
+float16_scale = 10000.0
+
+# "bands": one 2-D dataset per band-year (YEAR_BAND) and labels_2017 at the root.
+# "interleaved": one (H, W, C) dataset per year (features/YEAR) chunked (tile, tile, C) so that a
+# single chunk decode yields a training/inference tile, band order in its "band_names" attribute,
+# and labels/labels_2017 on the same tile grid.
+layout = "bands"
+
+# Reader threads: each reads and converts (and, for gzip, compresses) windows from all VRTs at once,
+# while the main thread is the only one touching the h5py.File. 1 = one window at a time.
+workers = 6
+# HDF5 raw-data chunk cache of the output file, in MB
+chunk_cache_mb = 64
+# Bins of the per-tile label class histogram in the tile index (higher labels go to the last bin)
+label_classes = 8
+# Append to an existing output_h5: add new or changed band-years, finish interrupted ones
+incremental = True
 
 def window_generator(width, height, tile_size):
     """Yield rasterio Windows for chunked reading."""
@@ -25,35 +58,329 @@ def window_generator(width, height, tile_size):
             win_height = min(tile_size, height - row_off)
             yield Window(col_off, row_off, win_width, win_height), (row_off, col_off, win_height, win_width)
 
-# Get VRT files
-vrt_files = sorted(f for f in os.listdir(bands_directory) if f.endswith(".vrt"))
-if not vrt_files:
-    raise Exception("No VRT files found.")
-
-with h5py.File(output_h5, "w") as h5f:
-    for file_name in vrt_files:
-        file_path = os.path.join(bands_directory, file_name)
-        parts = file_name.split('_')
-        dataset_name = f"{parts[1]}_{parts[0]}" if len(parts) >= 3 else os.path.splitext(file_name)[0]
-
-        with rasterio.open(file_path) as src:
-            height, width = src.height, src.width
-            dset = h5f.create_dataset(
-                dataset_name, shape=(height, width), dtype="float32",
-                chunks=(tile_size, tile_size), compression=compression_type
-            )
-
-            for win, (row_off, col_off, win_height, win_width) in window_generator(width, height, tile_size):
-                data_block = src.read(1, window=win).astype(np.float32)
-                data_block[data_block == 0] = np.nan
-                dset[row_off:row_off+win_height, col_off:col_off+win_width] = data_block
-
-    with rasterio.open(label_file) as src:
-        height, width = src.height, src.width
-        dset_label = h5f.create_dataset(
-            "labels_2017", shape=(height, width), dtype="uint8",
-            chunks=(tile_size, tile_size), compression=compression_type
-        )
-
-        for win, (row_off, col_off, win_height, win_width) in window_generator(width, height, tile_size):
-            dset_label[row_off:row_off+win_height, col_off:col_off+win_width] = src.read(1, window=win).astype(np.uint8)
+def dataset_name_for(file_name):
+    """B04_2017_... .vrt -> 2017_B04; anything else keeps its stem."""
+    parts = file_name.split('_')
+    return f"{parts[1]}_{parts[0]}" if len(parts) >= 3 else os.path.splitext(file_name)[0]
+
+def band_year_for(file_name):
+    """B04_2017_... .vrt -> ("B04", "2017"); anything else is (stem, None)."""
+    parts = file_name.split('_')
+    return (parts[0], parts[1]) if len(parts) >= 3 else (os.path.splitext(file_name)[0], None)
+
+def manifest_vrts(manifest_path):
+    """{file name: path} of the VRTs in a vrt_manifest.json, warning about sources off the common grid."""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    vrts = {}
+    for vrt in manifest["vrts"]:
+        if vrt["misaligned"]:
+            print(f"Warning: {vrt['path']} has {len(vrt['misaligned'])} sources off the common grid")
+        vrts[os.path.basename(vrt["path"])] = vrt["path"]
+    return vrts
+
+def ingestion_jobs(bands_directory, label_file, layout=layout, manifest=None):
+    """
+    [(dataset name, source, kind)] for the band VRTs (those of the manifest, if it exists) and the
+    label raster. In the interleaved layout the source of a feature dataset is the list of band
+    VRTs of one year, in band order.
+    """
+    if manifest and os.path.exists(manifest):
+        vrt_paths = manifest_vrts(manifest)
+    else:
+        vrt_paths = {f: os.path.join(bands_directory, f) for f in os.listdir(bands_directory) if f.endswith(".vrt")}
+    vrt_files = sorted(vrt_paths)
+    if not vrt_files:
+        raise Exception("No VRT files found.")
+    if layout == "bands":
+        jobs = [(dataset_name_for(f), vrt_paths[f], "feature") for f in vrt_files]
+        jobs.append(("labels_2017", label_file, "label"))
+        return jobs
+    if layout != "interleaved":
+        raise ValueError(f"Unknown layout: {layout}")
+
+    years = {}
+    for f in vrt_files:
+        band, year = band_year_for(f)
+        years.setdefault(year, []).append((band, vrt_paths[f]))
+    jobs = [(f"features/{year or 'stack'}", [path for _, path in sorted(bands)], "feature")
+            for year, bands in sorted(years.items(), key=lambda item: item[0] or "")]
+    jobs.append(("labels/labels_2017", label_file, "label"))
+    return jobs
+
+feature_dtypes = {"float32": np.float32, "uint16": np.uint16, "float16": np.float16}
+
+def storage_dtype(kind, feature_dtype=feature_dtype):
+    if kind == "label":
+        return np.uint8
+    if feature_dtype not in feature_dtypes:
+        raise ValueError(f"Unknown feature dtype: {feature_dtype}")
+    return feature_dtypes[feature_dtype]
+
+def storage_attrs(kind, feature_dtype=feature_dtype, scale=float16_scale):
+    """Attributes describing how stored feature values map back to float32 with NaN."""
+    if kind == "label" or feature_dtype == "float32":
+        return {}
+    if feature_dtype == "uint16":
+        return {"nodata": 0}
+    return {"scale_factor": scale}
+
+def convert_block(data, kind, feature_dtype=feature_dtype, scale=float16_scale):
+    """Band values as float32 with 0 -> NaN (or uint16 / scaled float16, see feature_dtype); labels as uint8."""
+    if kind == "label":
+        return data.astype(np.uint8)
+    if feature_dtype == "uint16":
+        return data.astype(np.uint16)
+    nodata = data == 0
+    data = data.astype(np.float32)
+    if feature_dtype == "float16":
+        data /= scale
+    data[nodata] = np.nan
+    return data.astype(storage_dtype(kind, feature_dtype), copy=False)
+
+def compression_kwargs(compression, level=compression_level):
+    """h5py create_dataset keywords for a codec name."""
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": level}
+    if compression == "lzf":
+        return {"compression": "lzf"}
+    if compression == "blosc-zstd":
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("blosc-zstd compression needs the hdf5plugin package") from None
+        return dict(hdf5plugin.Blosc(cname="zstd", clevel=min(level, 9), shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if compression is None:
+        return {}
+    raise ValueError(f"Unknown compression: {compression}")
+
+_thread_state = threading.local()
+_open_handles = []
+_open_handles_lock = threading.Lock()
+
+def _thread_dataset(path):
+    """rasterio datasets are not thread-safe, so every reader thread keeps its own handle per file."""
+    handles = getattr(_thread_state, "handles", None)
+    if handles is None:
+        handles = _thread_state.handles = {}
+    if path not in handles:
+        handles[path] = rasterio.open(path)
+        with _open_handles_lock:
+            _open_handles.append(handles[path])
+    return handles[path]
+
+def _close_thread_datasets():
+    with _open_handles_lock:
+        for src in _open_handles:
+            src.close()
+        _open_handles.clear()
+
+def tile_summary(data, kind, label_classes=label_classes):
+    """
+    Tile index entry: fraction of pixels valid in every band for features, class histogram
+    (label_classes bins) for labels.
+    """
+    if kind == "label":
+        return np.bincount(np.minimum(data.ravel(), label_classes - 1), minlength=label_classes)
+    valid = ~np.isnan(data) if data.dtype.kind == "f" else data != 0
+    if valid.ndim == 3:
+        valid = valid.all(axis=2)
+    return valid.mean()
+
+def read_tile(paths, kind, window, tile_size, direct_chunks, level, encoding, label_classes=label_classes):
+    """
+    Reads and converts one window: (h, w) from a single source, or (h, w, C) stacked from a list of
+    band sources, and returns it with its tile_summary. With direct_chunks the block is padded to a
+    full chunk and deflated here, so the writer only copies bytes into the file (H5Dwrite_chunk).
+    Feature tiles without any valid pixel come back as None and are not written at all (they read as
+    the dataset's fill value, NaN or 0).
+    """
+    t0 = time.perf_counter()
+    if isinstance(paths, str):
+        data = convert_block(_thread_dataset(paths).read(1, window=window), kind, *encoding)
+    else:
+        data = np.stack([convert_block(_thread_dataset(path).read(1, window=window), kind, *encoding) for path in paths], axis=-1)
+    summary = tile_summary(data, kind, label_classes)
+    if kind == "feature" and summary == 0:
+        return None, time.perf_counter() - t0, summary
+    if direct_chunks:
+        chunk_shape = (tile_size, tile_size) + data.shape[2:]
+        if data.shape != chunk_shape:
+            fill = np.nan if data.dtype.kind == "f" else 0
+            padded = np.full(chunk_shape, fill, dtype=data.dtype)
+            padded[:data.shape[0], :data.shape[1]] = data
+            data = padded
+        data = zlib.compress(data.tobytes(), level)
+    return data, time.perf_counter() - t0, summary
+
+def source_signature(paths):
+    """Path, mtime and size of every source file of a dataset."""
+    return [{"path": os.path.abspath(p), "mtime": os.path.getmtime(p), "size": os.path.getsize(p)} for p in paths]
+
+def _resume_state(h5f, name, signature):
+    """Completed-window mask of a dataset written from the same sources and settings, else None."""
+    manifest_name = f"manifest/{name}"
+    if name not in h5f or manifest_name not in h5f or h5f[manifest_name].attrs.get("signature") != signature:
+        return None
+    return h5f[manifest_name][:].astype(bool)
+
+def _tile_jobs(name, path, kind, width, height, tile_size, done):
+    for win, offsets in window_generator(width, height, tile_size):
+        if not done[offsets[0] // tile_size, offsets[1] // tile_size]:
+            yield name, path, kind, win, offsets
+
+def _interleave(generators):
+    """Round-robin over the window generators, so that all sources are read at the same time."""
+    generators = deque(generators)
+    while generators:
+        gen = generators.popleft()
+        item = next(gen, None)
+        if item is not None:
+            yield item
+            generators.append(gen)
+
+def build_h5(output_h5, jobs, tile_size=tile_size, compression=compression_type,
+             compression_level=compression_level, workers=workers, chunk_cache_mb=chunk_cache_mb,
+             feature_dtype=feature_dtype, float16_scale=float16_scale, incremental=False, flush_every=256,
+             label_classes=label_classes):
+    """
+    Writes every (dataset name, source, kind) job to its own chunked dataset in output_h5 and returns
+    per-dataset throughput stats. Windows of all sources are read by `workers` threads; the calling
+    thread is the single writer. A list of sources becomes one band-interleaved (H, W, C) dataset.
+
+    Every dataset has a manifest (manifest/<name>): a mask of completed windows, flushed to the file
+    every `flush_every` tiles, and a signature of its sources (path, mtime, size) and storage
+    settings. With incremental=True the file is opened for append: datasets with an unchanged
+    signature only get their missing windows, new or changed ones are (re)written from scratch.
+    Space of replaced datasets is only reclaimed by h5repack.
+
+    The tile index (tile_index/<name>, on the tile_size grid, flushed with the manifests) holds the
+    fraction of valid pixels per feature tile and the label class histogram per label tile, see
+    tile_summary. Feature tiles with no valid pixel are not stored.
+    """
+    direct_chunks = compression == "gzip"
+    encoding = (feature_dtype, float16_scale)
+    codec = compression_kwargs(compression, compression_level)
+    stats = {}
+    cache_bytes = chunk_cache_mb * 1024 * 1024
+    # ~10 hash slots per float32 chunk that fits in the cache, as the HDF5 docs recommend
+    cache_slots = max(521, 10 * cache_bytes // (tile_size * tile_size * 4))
+    with h5py.File(output_h5, "a" if incremental else "w", rdcc_nbytes=cache_bytes, rdcc_nslots=cache_slots) as h5f:
+        dsets, manifests, indexes = {}, {}, {}
+        tile_windows = []
+        file_layout = "interleaved" if any(not isinstance(path, str) for _, path, _ in jobs) else "bands"
+        if h5f.attrs.get("layout", file_layout) != file_layout or h5f.attrs.get("tile_size", tile_size) != tile_size:
+            raise ValueError(f"{output_h5} has layout {h5f.attrs['layout']} / tile size {h5f.attrs['tile_size']}, "
+                             f"rebuild it with incremental=False to change them")
+        h5f.attrs["layout"] = file_layout
+        h5f.attrs["tile_size"] = tile_size
+        for name, path, kind in jobs:
+            paths = [path] if isinstance(path, str) else list(path)
+            shapes = set()
+            for band_path in paths:
+                with rasterio.open(band_path) as src:
+                    shapes.add((src.height, src.width))
+            if len(shapes) != 1:
+                raise ValueError(f"Sources of {name} differ in size: {sorted(shapes)}")
+            height, width = shapes.pop()
+            band_shape = () if isinstance(path, str) else (len(paths),)
+            signature = json.dumps({"sources": source_signature(paths), "dtype": np.dtype(storage_dtype(kind, feature_dtype)).name,
+                                    "attrs": storage_attrs(kind, feature_dtype, float16_scale), "compression": compression,
+                                    "compression_level": compression_level, "label_classes": label_classes})
+
+            done = _resume_state(h5f, name, signature)
+            if done is None:
+                for stale in (name, f"manifest/{name}", f"tile_index/{name}"):
+                    if stale in h5f:
+                        del h5f[stale]
+                dtype = storage_dtype(kind, feature_dtype)
+                dset = h5f.create_dataset(
+                    name, shape=(height, width) + band_shape, dtype=dtype, chunks=(tile_size, tile_size) + band_shape,
+                    fillvalue=np.nan if np.dtype(dtype).kind == "f" else 0, **codec
+                )
+                dset.attrs.update(storage_attrs(kind, feature_dtype, float16_scale))
+                if band_shape:
+                    dset.attrs["band_names"] = [band_year_for(os.path.basename(p))[0] for p in paths]
+                    dset.attrs["sources"] = paths
+                done = np.zeros((-(-height // tile_size), -(-width // tile_size)), dtype=bool)
+                h5f.create_dataset(f"manifest/{name}", data=done.astype(np.uint8)).attrs["signature"] = signature
+                index = h5f.create_dataset(f"tile_index/{name}", shape=done.shape + ((label_classes,) if kind == "label" else ()),
+                                           dtype=np.uint32 if kind == "label" else np.float32)
+                index.attrs["kind"] = kind
+            dsets[name] = h5f[name]
+            manifests[name] = done
+            indexes[name] = h5f[f"tile_index/{name}"][...]
+            stats[name] = {"dataset": name, "source": path, "shape": (height, width), "tiles": 0,
+                           "skipped": int(done.sum()), "read_s": 0.0, "write_s": 0.0, "start": None, "end": None}
+            tile_windows.append(_tile_jobs(name, path, kind, width, height, tile_size, done))
+
+        unflushed = set()
+
+        def flush_manifests():
+            for name in unflushed:
+                h5f[f"manifest/{name}"][...] = manifests[name]
+                h5f[f"tile_index/{name}"][...] = indexes[name]
+            unflushed.clear()
+            h5f.flush()
+
+        def write(name, offsets, data, read_s, summary):
+            row_off, col_off, win_height, win_width = offsets
+            t0 = time.perf_counter()
+            if data is None:
+                pass
+            elif direct_chunks:
+                dsets[name].id.write_direct_chunk((row_off, col_off) + (0,) * (dsets[name].ndim - 2), data)
+            else:
+                dsets[name][row_off:row_off+win_height, col_off:col_off+win_width] = data
+            manifests[name][row_off // tile_size, col_off // tile_size] = True
+            indexes[name][row_off // tile_size, col_off // tile_size] = summary
+            unflushed.add(name)
+            s = stats[name]
+            s["end"] = time.perf_counter()
+            s["write_s"] += s["end"] - t0
+            s["read_s"] += read_s
+            s["tiles"] += 1
+            if sum(st["tiles"] for st in stats.values()) % flush_every == 0:
+                flush_manifests()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                for name, path, kind, win, offsets in _interleave(tile_windows):
+                    if stats[name]["start"] is None:
+                        stats[name]["start"] = time.perf_counter()
+                    pending.append((name, offsets, executor.submit(read_tile, path, kind, win, tile_size, direct_chunks,
+                                                                         compression_level, encoding, label_classes)))
+                    # bounded in-flight tiles keep memory flat while the writer catches up
+                    while len(pending) >= 2 * workers:
+                        name_done, offsets_done, future = pending.popleft()
+                        write(name_done, offsets_done, *future.result())
+                while pending:
+                    name_done, offsets_done, future = pending.popleft()
+                    write(name_done, offsets_done, *future.result())
+        finally:
+            _close_thread_datasets()
+            # whatever was written before an error is kept as completed, so a rerun resumes after it
+            flush_manifests()
+
+        for name, s in stats.items():
+            s["stored_mb"] = dsets[name].id.get_storage_size() / 1024 / 1024
+    return list(stats.values())
+
+def print_throughput(stats):
+    """Per-dataset tiles written and already complete, wall time (first read to last write), read/convert and write time and MPix/s."""
+    print(f"{'dataset':<20}{'tiles':>7}{'resumed':>9}{'wall s':>9}{'read s':>9}{'write s':>9}{'MPix/s':>9}{'stored MB':>11}")
+    for s in stats:
+        wall = (s["end"] - s["start"]) if s["tiles"] else 0.0
+        mpix = s["shape"][0] * s["shape"][1] / 1e6 * s["tiles"] / max(1, s["tiles"] + s["skipped"])
+        print(f"{s['dataset']:<20}{s['tiles']:>7}{s['skipped']:>9}{wall:>9.2f}{s['read_s']:>9.2f}{s['write_s']:>9.2f}"
+              f"{mpix / wall if wall else 0:>9.1f}{s['stored_mb']:>11.1f}")
+
+def main():
+    t0 = time.perf_counter()
+    stats = build_h5(output_h5, ingestion_jobs(bands_directory, label_file, layout, vrt_manifest), incremental=incremental)
+    print_throughput(stats)
+    print(f"Wrote {output_h5} in {time.perf_counter() - t0:.1f} s")
+
+if __name__ == "__main__":
+    main()
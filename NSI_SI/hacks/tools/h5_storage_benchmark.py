@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Alen Mangafić
+"""
+import os
+import sys
+import time
+import argparse
+import h5py
+import rasterio
+import numpy as np
+from rasterio.transform import from_origin
+
+import gdal2h5
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "unet_mini"))
+from h5_tiles import feature_shape, read_feature_tile
+
+# (feature dtype, codec) combinations written and read back; float32/gzip is the current ard.h5
+variants = [("float32", "gzip"), ("uint16", "gzip"), ("uint16", "lzf"), ("uint16", "blosc-zstd"),
+            ("float16", "gzip"), ("float16", "lzf"), ("float16", "blosc-zstd")]
+
+def write_synthetic_bands(directory, size, years=(2017, 2018), bands=("B04", "B11", "B12"), seed=0):
+    """Reflectance-like uint16 band rasters (smooth fields plus noise, a nodata margin) and labels."""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    profile = dict(driver="GTiff", width=size, height=size, count=1, crs="EPSG:3035",
+                   transform=from_origin(3769660, 3489900, 20, 20), tiled=True, blockxsize=256, blockysize=256)
+    for year in years:
+        for i, band in enumerate(bands):
+            field = 1500 + 800 * np.sin(xx / (40 + 10 * i)) * np.cos(yy / 55) + rng.normal(0, 120, (size, size))
+            data = np.clip(field, 1, 10000).astype(np.uint16)
+            data[:, :size // 20] = 0
+            with rasterio.open(os.path.join(directory, f"{band}_{year}_20m.tif"), "w", dtype="uint16", **profile) as dst:
+                dst.write(data, 1)
+    labels = ((xx // 64 + yy // 48) % 3).astype(np.uint8)
+    label_file = os.path.join(directory, "labels.tif")
+    with rasterio.open(label_file, "w", dtype="uint8", **profile) as dst:
+        dst.write(labels, 1)
+    return directory, label_file
+
+def synthetic_jobs(directory, label_file, layout):
+    """ingestion_jobs for the .tif stand-ins of the band VRTs."""
+    for name in os.listdir(directory):
+        if name.endswith("_20m.tif") and not os.path.exists(os.path.join(directory, name[:-4] + ".vrt")):
+            os.symlink(name, os.path.join(directory, name[:-4] + ".vrt"))
+    return gdal2h5.ingestion_jobs(directory, label_file, layout)
+
+def feature_sources(h5file):
+    """(name, source) for every feature dataset of a gdal2h5 file, as read_feature_tile takes them."""
+    if "features" in h5file:
+        return [(name, (dset, list(range(dset.shape[2])))) for name, dset in h5file["features"].items()]
+    return [(name, [dset]) for name, dset in h5file.items() if isinstance(dset, h5py.Dataset) and not name.startswith("labels")]
+
+def read_all_tiles(h5_path, tile_size):
+    """Reads every feature tile through the unet_mini readers; returns (seconds, tiles, decoded arrays)."""
+    tiles, arrays = 0, {}
+    with h5py.File(h5_path, "r") as h5file:
+        t0 = time.perf_counter()
+        for name, source in feature_sources(h5file):
+            rows, cols = feature_shape(source)
+            out = arrays[name] = np.empty((rows, cols, source[0].shape[2] if source[0].ndim == 3 else 1), np.float32)
+            for row in range(0, rows, tile_size):
+                for col in range(0, cols, tile_size):
+                    tile = read_feature_tile(source, row, col, tile_size)
+                    out[row:row + tile_size, col:col + tile_size] = tile[:rows - row, :cols - col]
+                    tiles += 1
+        return time.perf_counter() - t0, tiles, arrays
+
+def run_benchmark(jobs, workdir, tile_size=gdal2h5.tile_size, workers=gdal2h5.workers):
+    rows, reference = [], None
+    for feature_dtype, codec in variants:
+        try:
+            gdal2h5.compression_kwargs(codec)
+        except ImportError as e:
+            print(f"Skipping {feature_dtype}/{codec}: {e}")
+            continue
+        path = os.path.join(workdir, f"ard_{feature_dtype}_{codec}.h5")
+        t0 = time.perf_counter()
+        gdal2h5.build_h5(path, jobs, tile_size=tile_size, compression=codec, workers=workers, feature_dtype=feature_dtype)
+        build_s = time.perf_counter() - t0
+        read_s, tiles, arrays = read_all_tiles(path, tile_size)
+        if reference is None:
+            reference = arrays
+        max_error = max(float(np.nanmax(np.abs(arrays[k] - reference[k]))) for k in arrays)
+        same_nan = all(np.array_equal(np.isnan(arrays[k]), np.isnan(reference[k])) for k in arrays)
+        rows.append((feature_dtype, codec, os.path.getsize(path) / 1024 / 1024, build_s, read_s, tiles / read_s, max_error, same_nan))
+
+    print(f"{'dtype':<9}{'codec':<12}{'size MB':>9}{'build s':>9}{'read s':>8}{'tiles/s':>9}{'max err':>9}{'NaN ok':>8}")
+    for feature_dtype, codec, size_mb, build_s, read_s, rate, max_error, same_nan in rows:
+        print(f"{feature_dtype:<9}{codec:<12}{size_mb:>9.1f}{build_s:>9.2f}{read_s:>8.2f}{rate:>9.0f}{max_error:>9.2f}{str(same_nan):>8}")
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="File size and read speed of ard.h5 storage dtypes and codecs.")
+    parser.add_argument("--bands-dir", default=gdal2h5.bands_directory)
+    parser.add_argument("--label-file", default=gdal2h5.label_file)
+    parser.add_argument("--synthetic", type=int, metavar="SIZE", help="use SIZE x SIZE synthetic rasters instead")
+    parser.add_argument("--layout", default=gdal2h5.layout, choices=("bands", "interleaved"))
+    parser.add_argument("--workdir", default="h5_benchmark")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    if args.synthetic:
+        bands_dir, label_file = write_synthetic_bands(os.path.join(args.workdir, "bands"), args.synthetic)
+        jobs = synthetic_jobs(bands_dir, label_file, args.layout)
+    else:
+        jobs = gdal2h5.ingestion_jobs(args.bands_dir, args.label_file, args.layout)
+    run_benchmark(jobs, args.workdir)
+
+if __name__ == "__main__":
+    main()
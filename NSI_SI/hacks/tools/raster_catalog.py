@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Alen Mangafić
+"""
+import os
+import sqlite3
+import argparse
+import concurrent.futures
+import rasterio
+
+# SQLite index of the band rasters under base_dir/{year}/{band}/ (and of any other rasters, e.g. the
+# VRTs) with their size, mtime, CRS, bounds and resolution. A refresh only stats the directories
+# and opens the files whose size or mtime changed, so min_common_tiles.py, s2bands_to_yearly_vrt.py
+# and vrt_extent_check.py query the index instead of crawling and opening every file.
+COLUMNS = ("path", "directory", "year", "band", "tile", "size", "mtime", "crs",
+           "left", "bottom", "right", "top", "xres", "yres", "width", "height")
+
+def tile_of(filename):
+    """Tile ID from a band file name, e.g. T31UFT_20170610T103019_B04_20m_EPSG3035.tif -> T31UFT."""
+    return filename.split("_")[0]
+
+def raster_metadata(path):
+    with rasterio.open(path) as src:
+        return (src.crs.to_string() if src.crs else None, *src.bounds, *src.res, src.width, src.height)
+
+class RasterCatalog:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS rasters (
+                path TEXT PRIMARY KEY, directory TEXT, year INTEGER, band TEXT, tile TEXT, size INTEGER,
+                mtime REAL, crs TEXT, left REAL, bottom REAL, right REAL, top REAL, xres REAL, yres REAL,
+                width INTEGER, height INTEGER);
+            CREATE INDEX IF NOT EXISTS rasters_directory ON rasters (directory);
+            CREATE INDEX IF NOT EXISTS rasters_band_year ON rasters (band, year, tile);
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def refresh_directory(self, directory, year=None, band=None, extensions=(".tif",), workers=8):
+        """
+        Brings the rows of one directory up to date: new files and files whose size or mtime
+        changed are (re)read, vanished ones dropped. Returns (updated, removed, unchanged).
+        """
+        known = {path: (size, mtime) for path, size, mtime in
+                 self.db.execute("SELECT path, size, mtime FROM rasters WHERE directory = ?", (directory,))}
+        changed, seen = [], set()
+        if os.path.isdir(directory):
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(tuple(extensions)) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    seen.add(entry.path)
+                    if known.get(entry.path) != (stat.st_size, stat.st_mtime):
+                        changed.append((entry.path, entry.name, stat))
+        removed = [path for path in known if path not in seen]
+
+        # opening the rasters is the slow part, so only the changed ones are read, in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            metadata = list(executor.map(raster_metadata, [path for path, _, _ in changed]))
+        with self.db:
+            self.db.executemany("DELETE FROM rasters WHERE path = ?", [(path,) for path in removed])
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO rasters VALUES ({', '.join('?' * len(COLUMNS))})",
+                [(path, directory, year, band if band is not None else os.path.splitext(name)[0],
+                  tile_of(name) if band is not None else None, stat.st_size, stat.st_mtime, *meta)
+                 for (path, name, stat), meta in zip(changed, metadata)])
+        return len(changed), len(removed), len(seen) - len(changed)
+
+    def refresh(self, base_dir, years, bands, workers=8):
+        """Refreshes base_dir/{year}/{band}/*.tif for every year and band; returns the summed counts."""
+        totals = [0, 0, 0]
+        for year in years:
+            for band in bands:
+                counts = self.refresh_directory(os.path.join(base_dir, str(year), band), year, band, workers=workers)
+                totals = [total + count for total, count in zip(totals, counts)]
+        return tuple(totals)
+
+    def tiles(self, year, band):
+        return {tile for tile, in self.db.execute(
+            "SELECT DISTINCT tile FROM rasters WHERE year = ? AND band = ?", (year, band))}
+
+    def common_tiles(self, years, band):
+        """Tiles that have a `band` raster in every one of `years`."""
+        years = list(years)
+        return {tile for tile, in self.db.execute(f"""
+            SELECT tile FROM rasters WHERE band = ? AND year IN ({', '.join('?' * len(years))})
+            GROUP BY tile HAVING COUNT(DISTINCT year) = ?""", [band, *years, len(years)])}
+
+    def _band_filter(self, band, years, tiles):
+        conditions, params = ["band = ?"], [band]
+        for column, values in (("year", years), ("tile", tiles)):
+            if values is not None:
+                values = list(values)
+                conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        return " AND ".join(conditions), params
+
+    def files(self, band, years=None, tiles=None):
+        """Sorted paths of a band's rasters, optionally only of some years and tiles."""
+        where, params = self._band_filter(band, years, tiles)
+        return [path for path, in self.db.execute(f"SELECT path FROM rasters WHERE {where} ORDER BY path", params)]
+
+    def records(self, band, years=None, tiles=None):
+        """Like files, but every row as a {column: value} dict."""
+        where, params = self._band_filter(band, years, tiles)
+        return [dict(zip(COLUMNS, row)) for row in
+                self.db.execute(f"SELECT {', '.join(COLUMNS)} FROM rasters WHERE {where} ORDER BY path", params)]
+
+    def extents(self, directory=None):
+        """{(left, bottom, right, top): [paths]} of the indexed rasters (of one directory)."""
+        sql, params = "SELECT path, left, bottom, right, top FROM rasters", ()
+        if directory is not None:
+            sql, params = sql + " WHERE directory = ?", (directory,)
+        groups = {}
+        for path, *bounds in self.db.execute(sql + " ORDER BY path", params):
+            groups.setdefault(tuple(bounds), []).append(path)
+        return groups
+
+    def resolutions(self, band=None):
+        """{(crs, xres, yres): count} of the indexed rasters, to spot files off the common grid."""
+        sql, params = "SELECT crs, xres, yres, COUNT(*) FROM rasters", ()
+        if band is not None:
+            sql, params = sql + " WHERE band = ?", (band,)
+        return {(crs, xres, yres): count for crs, xres, yres, count in
+                self.db.execute(sql + " GROUP BY crs, xres, yres", params)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the raster catalog of a Sentinel-2 band directory tree.")
+    parser.add_argument("base_dir")
+    parser.add_argument("--catalog", help="SQLite file (default: BASE_DIR/catalog.sqlite)")
+    parser.add_argument("--years", type=int, nargs="+", default=list(range(2017, 2024)))
+    parser.add_argument("--bands", nargs="+", default=["B04_20m", "B11_20m", "B12_20m"])
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    catalog = RasterCatalog(args.catalog or os.path.join(args.base_dir, "catalog.sqlite"))
+    updated, removed, unchanged = catalog.refresh(args.base_dir, args.years, args.bands, args.workers)
+    print(f"Catalog: {updated} updated, {removed} removed, {unchanged} unchanged")
+    for band in args.bands:
+        print(band, {year: len(catalog.tiles(year, band)) for year in args.years}, catalog.resolutions(band))
+    catalog.close()
+
+if __name__ == "__main__":
+    main()
@@ -3,137 +3,391 @@
 """
 @author: Alen Mangafić
 """
-import requests
-import pickle
-import rasterio
-import concurrent.futures
+import os
+import math
 import time
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+import shutil
+import tempfile
+import contextlib
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import rasterio
+from rasterio.shutil import copyfiles
+from rasterio.warp import calculate_default_transform, reproject, transform_bounds, Resampling
+from rasterio.windows import Window, transform as window_transform
+from rasterio.transform import from_origin
 from rasterio.crs import CRS
 
+from stac_client import StacCache, cached_search
+from fetch_journal import FetchJournal
+
 # STAC API and processing parameters
 BASE_URL = "https://stac.dataspace.copernicus.eu/v1/search"
 bands = ['B12_20m', 'B11_20m', 'B04_20m']
 output_crs = CRS.from_epsg(3035)
 years = range(2023, 2024)
+# Journal of (year, tile, band) outputs: in_progress, done or failed; processed_tiles.pkl of older
+# runs is taken over as done
+journal_path = "/path/to/processed_tiles.sqlite"
 processed_tiles_path = "/path/to/processed_tiles.pkl"
 
-# Load processed tiles
-if os.path.exists(processed_tiles_path):
-    with open(processed_tiles_path, 'rb') as f:
-        processed_tiles = pickle.load(f)
-else:
-    processed_tiles = set()
-
-for year in years:
-    pickle_path = f"/path/to/{year}_query.pkl"
-    all_features = []
-
-    # Load previous queries
-    if os.path.exists(pickle_path):
-        print(f"Loading saved features for {year}")
-        with open(pickle_path, 'rb') as f:
-            all_features = pickle.load(f)
-
-    # Query STAC if no saved data
-    if not all_features:
-        print(f"Fetching new data for {year}...")
-        query = {
-            "collections": ["sentinel-2-l2a"],
-            "datetime": f"{year}-05-01T00:00:00Z/{year}-06-01T23:59:59Z",
-            "limit": 1000,
-            "query": {"eo:cloud_cover": {"gte": 0, "lt": 6}},
-            "intersects": {
-                "type": "Polygon",
-                "coordinates": [[
-                    [3.46, 44.90], [18.68, 44.90], [18.68, 53.71],
-                    [3.46, 53.71], [3.46, 44.90]
-                ]]
-            }
-        }
-
-        next_url = BASE_URL
-        while next_url:
-            try:
-                response = requests.post(next_url, json=query) if next_url == BASE_URL else requests.get(next_url)
-                response.raise_for_status()
-                data = response.json()
-                all_features.extend(data.get("features", []))
-                next_url = next((link["href"] for link in data.get("links", []) if link.get("rel") == "next"), None)
-            except requests.HTTPError as e:
-                print(f"Request failed: {e}")
+# Warp every band straight onto the common 20 m grid of s2bands_to_yearly_vrt.py and
+# clip_and_resample_s2glc.py instead of a per-scene grid, so the yearly VRTs are pure mosaics.
+# Outputs cover the scene footprint in whole grid_block x grid_block blocks of that grid (and are
+# tiled with the same blocks); outside the footprint is nodata 0.
+warp_to_grid = True
+common_extent = (3769660, 2336620, 5109780, 3489900)
+grid_resolution = 20
+grid_block = 512
+
+# Reprojection runs in warp_processes processes, each with a GDAL block cache of gdal_cache_mb.
+# Bands are warped in warp_window x warp_window output windows with warp_threads GDAL warp threads
+# and at most warp_memory_mb of warp buffer, so memory does not grow with the scene size.
+warp_processes = 4
+warp_threads = 2
+warp_memory_mb = 256
+gdal_cache_mb = 256
+warp_window = 2048
+# Local copies of the JP2s while they are warped (None: system temp directory)
+download_dir = None
+
+# Composite up to composite_scenes scenes per tile instead of keeping only the largest one:
+# "median" takes the per-pixel median of the valid values, "lowest_cloud" the value of the least
+# cloudy scene that has one (None: largest scene, no compositing). Scenes are streamed window by
+# window, so memory depends on warp_window and composite_scenes, not on the scene size.
+composite_method = None
+composite_scenes = 5
+
+# Item cache shared by all years; a year is only searched again with refresh_search = True
+# (or once its search is older than search_max_age_days)
+stac_cache_path = "/path/to/stac_items.sqlite"
+refresh_search = False
+search_max_age_days = None
+max_cloud_cover = 6
+area_of_interest = {
+    "type": "Polygon",
+    "coordinates": [[
+        [3.46, 44.90], [18.68, 44.90], [18.68, 53.71],
+        [3.46, 53.71], [3.46, 44.90]
+    ]]
+}
+
+def year_query(year):
+    """STAC search body for the May scenes of a year."""
+    return {
+        "collections": ["sentinel-2-l2a"],
+        "datetime": f"{year}-05-01T00:00:00Z/{year}-06-01T23:59:59Z",
+        "limit": 1000,
+        "query": {"eo:cloud_cover": {"gte": 0, "lt": max_cloud_cover}},
+        "intersects": area_of_interest
+    }
+
+def select_scenes(cache, year):
+    """Largest scene per tile (we are assuming that the largest have all the area covered) from the cached items."""
+    return cache.select_scenes(bands, f"{year}-05-01", f"{year}-06-02", max_cloud_cover, "sentinel-2-l2a")
+
+def composite_candidates(cache, year):
+    """Up to composite_scenes scenes per tile, least cloudy first, from the cached items."""
+    return cache.candidate_scenes(bands, f"{year}-05-01", f"{year}-06-02", max_cloud_cover, "sentinel-2-l2a",
+                                  limit=composite_scenes)
+
+def band_output_path(href, year, band):
+    filename = href.split('/')[-1].replace('.jp2', '_EPSG3035.tif')
+    return f"/path/to/{year}/{band}/{filename}"
+
+def composite_output_path(tile_id, year, band):
+    # tile first, like the scene file names, so min_common_tiles.py reads it the same way
+    return f"/path/to/{year}/{band}/{tile_id}_{year}0501_{year}0601_{composite_method}_{band}_EPSG3035.tif"
+
+def start_band(band, output_path, year, tile_id, journal):
+    """Journals a band as in progress and returns its output path, or None if there is nothing to do."""
+    if journal.status(year, tile_id, band) is None and os.path.exists(output_path):
+        # written by a run before the journal existed
+        print(f"File {output_path} exists, skipping.")
+        journal.done(year, tile_id, band, output_path)
+        return None
+    if not journal.start(year, tile_id, band, output_path):
+        print(f"Skipping {year}, {tile_id}, {band}")
+        return None
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    return output_path
+
+def _init_warp_worker(cache_mb):
+    """
+    Per-process GDAL settings of the warp pool. GDAL falls back to environment variables for its
+    config options, so they hold for the life of the worker without an open rasterio.Env.
+    """
+    os.environ["GDAL_CACHEMAX"] = str(cache_mb)
+    os.environ["GDAL_NUM_THREADS"] = str(warp_threads)
+
+def grid_window(bounds):
+    """
+    Window of the common grid covering EPSG:3035 bounds, widened to whole grid blocks and clipped
+    to common_extent; None if they do not overlap.
+    """
+    xmin, ymin, xmax, ymax = common_extent
+    width = int(round((xmax - xmin) / grid_resolution))
+    height = int(round((ymax - ymin) / grid_resolution))
+    left, bottom, right, top = bounds
+    block = grid_resolution * grid_block
+    col_start = max(0, math.floor((left - xmin) / block) * grid_block)
+    row_start = max(0, math.floor((ymax - top) / block) * grid_block)
+    col_stop = min(width, math.ceil((right - xmin) / block) * grid_block)
+    row_stop = min(height, math.ceil((ymax - bottom) / block) * grid_block)
+    if col_stop <= col_start or row_stop <= row_start:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+def output_grid(src):
+    """(transform, width, height) of the EPSG:3035 output of a scene, or None if it is outside common_extent."""
+    if not warp_to_grid:
+        return calculate_default_transform(src.crs, output_crs, src.width, src.height, *src.bounds)
+    window = grid_window(transform_bounds(src.crs, output_crs, *src.bounds, densify_pts=21))
+    if window is None:
+        return None
+    grid = from_origin(common_extent[0], common_extent[3], grid_resolution, grid_resolution)
+    return window_transform(window, grid), int(window.width), int(window.height)
+
+def local_copy(href, local_dir, timings, prefix=""):
+    """Copies a band from S3 (or a local path) into local_dir; the time goes to the download stage."""
+    source = f'/vsis3/{href[5:]}' if href.startswith("s3://") else href
+    t0 = time.perf_counter()
+    local_path = os.path.join(local_dir, prefix + os.path.basename(href))
+    copyfiles(source, local_path)
+    timings["download"] += time.perf_counter() - t0
+    return local_path
+
+def output_profile(src, transform, width, height):
+    """Output profile: nodata 0 and tiled in grid blocks on the common grid, the source profile otherwise."""
+    kwargs = src.meta.copy()
+    kwargs.update({
+        'crs': output_crs, 'transform': transform,
+        'width': width, 'height': height,
+        'driver': 'GTiff', 'compress': 'LZW'
+    })
+    if warp_to_grid:
+        kwargs.update({'nodata': 0, 'tiled': True, 'blockxsize': grid_block, 'blockysize': grid_block})
+    return kwargs
+
+def warp_band(href, output_path):
+    """
+    Reprojects one band to EPSG:3035 (onto the common grid with warp_to_grid) and returns
+    (output path or None if the scene is outside the extent, {stage: seconds}). The JP2 is copied
+    to local disk first (download), then every warp_window x warp_window output window is read
+    from the matching source window (decode), warped (warp) and written (encode). The file only
+    appears under output_path once it is complete.
+    """
+    timings = dict.fromkeys(("download", "decode", "warp", "encode"), 0.0)
+    local_dir = tempfile.mkdtemp(dir=download_dir)
+    try:
+        local_path = local_copy(href, local_dir, timings)
+        with rasterio.open(local_path) as src:
+            grid = output_grid(src)
+            if grid is None:
+                return None, timings
+            transform, width, height = grid
+            part_path = f"{output_path}.part"
+            with rasterio.open(part_path, 'w', **output_profile(src, transform, width, height)) as dst:
+                for window in warp_windows(width, height):
+                    out = warp_window_array(src, dst.transform, window, dst.dtypes[0], timings)
+                    t0 = time.perf_counter()
+                    dst.write(out, 1, window=window)
+                    timings["encode"] += time.perf_counter() - t0
+                t0 = time.perf_counter()
+            timings["encode"] += time.perf_counter() - t0
+        os.replace(part_path, output_path)
+        return output_path, timings
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+def composite_grid(srcs):
+    """Output grid covering all scenes of a tile (they share the MGRS footprint, so usually one scene's grid)."""
+    if not warp_to_grid:
+        return output_grid(srcs[0])
+    windows = [grid_window(transform_bounds(src.crs, output_crs, *src.bounds, densify_pts=21)) for src in srcs]
+    windows = [window for window in windows if window is not None]
+    if not windows:
+        return None
+    window = rasterio.windows.union(*windows)
+    grid = from_origin(common_extent[0], common_extent[3], grid_resolution, grid_resolution)
+    return window_transform(window, grid), int(window.width), int(window.height)
+
+def composite_window(srcs, transform, window, dtype, method, timings):
+    """
+    Composite of one output window over the scenes (least cloudy first). lowest_cloud fills the
+    nodata pixels scene by scene and stops once the window is full; median holds one warped window
+    per scene and ignores nodata.
+    """
+    if method == "lowest_cloud":
+        out = np.zeros((int(window.height), int(window.width)), dtype=dtype)
+        for src in srcs:
+            data = warp_window_array(src, transform, window, dtype, timings)
+            t0 = time.perf_counter()
+            empty = out == 0
+            out[empty] = data[empty]
+            full = not (out == 0).any()
+            timings["composite"] += time.perf_counter() - t0
+            if full:
                 break
+        return out
+    if method == "median":
+        stack = np.empty((len(srcs), int(window.height), int(window.width)), dtype=np.float32)
+        for i, src in enumerate(srcs):
+            stack[i] = warp_window_array(src, transform, window, dtype, timings)
+        t0 = time.perf_counter()
+        # nodata sorts last as NaN, so the median of the n valid values sits at (n - 1) // 2 and n // 2
+        stack[stack == 0] = np.nan
+        valid = np.count_nonzero(~np.isnan(stack), axis=0)
+        stack.sort(axis=0)
+        low = np.take_along_axis(stack, np.maximum(valid - 1, 0)[None] // 2, axis=0)[0]
+        high = np.take_along_axis(stack, valid[None] // 2, axis=0)[0]
+        out = np.rint(np.where(valid > 0, (low + high) / 2, 0)).astype(dtype)
+        timings["composite"] += time.perf_counter() - t0
+        return out
+    raise ValueError(f"Unknown composite method {method!r}")
+
+def composite_band(hrefs, output_path, method):
+    """
+    Composites the scenes of one tile and band (hrefs least cloudy first) on the EPSG:3035 grid of
+    warp_band, window by window, so only warp_window x warp_window pixels per scene are in memory.
+    Returns (output path or None if the tile is outside the extent, {stage: seconds}).
+    """
+    timings = dict.fromkeys(("download", "decode", "warp", "composite", "encode"), 0.0)
+    local_dir = tempfile.mkdtemp(dir=download_dir)
+    try:
+        # the scenes of a tile can share a band file name
+        local_paths = [local_copy(href, local_dir, timings, prefix=f"{i}_") for i, href in enumerate(hrefs)]
+        with contextlib.ExitStack() as stack:
+            srcs = [stack.enter_context(rasterio.open(path)) for path in local_paths]
+            grid = composite_grid(srcs)
+            if grid is None:
+                return None, timings
+            transform, width, height = grid
+            part_path = f"{output_path}.part"
+            with rasterio.open(part_path, 'w', **output_profile(srcs[0], transform, width, height)) as dst:
+                for window in warp_windows(width, height):
+                    out = composite_window(srcs, dst.transform, window, dst.dtypes[0], method, timings)
+                    t0 = time.perf_counter()
+                    dst.write(out, 1, window=window)
+                    timings["encode"] += time.perf_counter() - t0
+                t0 = time.perf_counter()
+            timings["encode"] += time.perf_counter() - t0
+        os.replace(part_path, output_path)
+        return output_path, timings
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+def warp_windows(width, height):
+    for row_off in range(0, height, warp_window):
+        for col_off in range(0, width, warp_window):
+            yield Window(col_off, row_off, min(warp_window, width - col_off), min(warp_window, height - row_off))
+
+def warp_window_array(src, transform, window, dtype, timings):
+    """Warps the part of src under one window of the output grid `transform`; pixels the scene does not reach are nodata 0."""
+    out = np.zeros((int(window.height), int(window.width)), dtype=dtype)
+    left, bottom, right, top = transform_bounds(output_crs, src.crs, *rasterio.windows.bounds(window, transform), densify_pts=21)
+    src_window = src.window(left, bottom, right, top).round_offsets(op='floor').round_lengths(op='ceil')
+    # a few pixels of margin for the warper, clipped to the scene
+    col_off, row_off = max(0, int(src_window.col_off) - 2), max(0, int(src_window.row_off) - 2)
+    col_stop = min(src.width, int(src_window.col_off + src_window.width) + 2)
+    row_stop = min(src.height, int(src_window.row_off + src_window.height) + 2)
+    if col_stop <= col_off or row_stop <= row_off:
+        return out
+    src_window = Window(col_off, row_off, col_stop - col_off, row_stop - row_off)
+
+    t0 = time.perf_counter()
+    data = src.read(1, window=src_window)
+    t1 = time.perf_counter()
+    reproject(
+        source=data,
+        destination=out,
+        src_transform=src.window_transform(src_window),
+        src_crs=src.crs,
+        src_nodata=src.nodata,
+        dst_transform=window_transform(window, transform),
+        dst_crs=output_crs,
+        dst_nodata=0,
+        resampling=Resampling.nearest,
+        num_threads=warp_threads,
+        warp_mem_limit=warp_memory_mb
+    )
+    timings["decode"] += t1 - t0
+    timings["warp"] += time.perf_counter() - t1
+    return out
+
+def print_timings(label, timings):
+    total = sum(timings.values())
+    parts = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items())
+    print(f"Processed {label} in {total:.2f}s ({parts})")
+
+def main():
+    # Journal of processed tiles; bands interrupted last time are redone
+    journal = FetchJournal(journal_path)
+    journal.import_pickle(processed_tiles_path)
+    interrupted = journal.recover()
+    if interrupted:
+        print(f"Redoing {interrupted} bands interrupted in the last run")
+
+    cache = StacCache(stac_cache_path)
+    total_timings = dict.fromkeys(("download", "decode", "warp", "encode"), 0.0)
+    for year in years:
+        # Query STAC unless the cache already has this year's search
+        query = year_query(year)
+        n_items = cached_search(BASE_URL, query, cache, refresh=refresh_search, max_age_days=search_max_age_days)
+        if n_items is None:
+            print(f"Using cached items for {year}")
+        else:
+            print(f"Fetched {n_items} items for {year}")
+
+        scenes = composite_candidates(cache, year) if composite_method else select_scenes(cache, year)
+        if not scenes:
+            print(f"No valid scenes for {year}, skipping.")
+            continue
+
+        # Process in parallel; the journal is only written from this process
+        with concurrent.futures.ProcessPoolExecutor(max_workers=warp_processes, mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=_init_warp_worker, initargs=(gdal_cache_mb,)) as executor:
+            futures = {}
+            for tile_id, scene_data in scenes.items():
+                for band in bands:
+                    if composite_method:
+                        hrefs = [scene["assets"][band]["href"] for scene in scene_data
+                                 if band in scene["assets"] and scene["assets"][band]["href"].startswith("s3://")]
+                        if not hrefs:
+                            continue
+                        output_path = start_band(band, composite_output_path(tile_id, year, band), year, tile_id, journal)
+                        if output_path:
+                            futures[executor.submit(composite_band, hrefs, output_path, composite_method)] = (year, tile_id, band)
+                        continue
+                    if band not in scene_data["assets"] or not scene_data["assets"][band]["href"].startswith("s3://"):
+                        continue
+                    href = scene_data["assets"][band]["href"]
+                    output_path = start_band(band, band_output_path(href, year, band), year, tile_id, journal)
+                    if output_path:
+                        futures[executor.submit(warp_band, href, output_path)] = (year, tile_id, band)
+
+            for future in concurrent.futures.as_completed(futures):
+                year_done, tile_id, band = futures[future]
+                try:
+                    written, timings = future.result()
+                except Exception as e:
+                    journal.failed(year_done, tile_id, band, e)
+                    print(f"Failed {year_done}, {tile_id}, {band}: {e}")
+                    continue
+                journal.done(year_done, tile_id, band, written)
+                for stage, seconds in timings.items():
+                    total_timings[stage] = total_timings.get(stage, 0.0) + seconds
+                if written is None:
+                    print(f"{year_done}, {tile_id}, {band} is outside the common extent")
+                else:
+                    print_timings(f"{year_done}, {tile_id}, {band}", timings)
+    print_timings("all bands", total_timings)
+    print(f"Journal: {journal.summary()}")
+    for year, tile_id, band, _, attempts, error in journal.jobs("failed"):
+        print(f"Failed {year}, {tile_id}, {band} after {attempts} attempts: {error}")
+    journal.close()
+    cache.close()
 
-        with open(pickle_path, 'wb') as f:
-            pickle.dump(all_features, f)
-        print(f"Saved features for {year}")
-
-    if not all_features:
-        print(f"No data for {year}, skipping...")
-        continue
-
-    # Select the largest scene per tile
-    scenes = {}
-    for feature in all_features:
-        assets = feature.get("assets", {})
-        tile_id = feature.get("id", "").split('_')[-2]
-        total_size = sum(assets[band].get('file:size', 0) for band in bands if band in assets)
-        if tile_id and (tile_id not in scenes or scenes[tile_id]['size'] < total_size):
-            scenes[tile_id] = {'assets': assets, 'size': total_size}
-
-    if not scenes:
-        print(f"No valid scenes for {year}, skipping.")
-        continue
-
-    def process_band(band, href, year, tile_id):
-        start_time = time.time()
-
-        if (year, tile_id, band) in processed_tiles:
-            print(f"Skipping {year}, {tile_id}, {band}")
-            return
-
-        filename = href.split('/')[-1].replace('.jp2', '_EPSG3035.tif')
-        output_dir = f"/path/to/{year}/{band}"
-        os.makedirs(output_dir, exist_ok=True)
-        output_path = f"{output_dir}/{filename}"
-
-        if os.path.exists(output_path):
-            print(f"File {output_path} exists, skipping.")
-            return
-
-        with rasterio.open(f'/vsis3/{href[5:]}') as src:
-            transform, width, height = calculate_default_transform(
-                src.crs, output_crs, src.width, src.height, *src.bounds
-            )
-
-            kwargs = src.meta.copy()
-            kwargs.update({
-                'crs': output_crs, 'transform': transform,
-                'width': width, 'height': height,
-                'driver': 'GTiff', 'compress': 'LZW'
-            })
-
-            with rasterio.open(output_path, 'w', **kwargs) as dst:
-                reproject(
-                    source=rasterio.band(src, 1),
-                    destination=rasterio.band(dst, 1),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=output_crs,
-                    resampling=Resampling.nearest
-                )
-
-        print(f"Processed {year}, {tile_id}, {band} in {time.time() - start_time:.2f}s")
-        processed_tiles.add((year, tile_id, band))
-        with open(processed_tiles_path, 'wb') as f:
-            pickle.dump(processed_tiles, f)
-
-    # Process in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
-        futures = [
-            executor.submit(process_band, band, assets[band]["href"], year, tile_id)
-            for tile_id, scene_data in scenes.items()
-            for band in bands if band in scene_data["assets"] and scene_data["assets"][band]["href"].startswith("s3://")
-        ]
-        concurrent.futures.wait(futures)
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,9 @@
 @author: Alen Mangafić
 """
 import os
-import glob
-import subprocess
+
+from raster_catalog import RasterCatalog
+from vrt_builder import build_vrts, list_file_records
 
 # Base directory where Sentinel-2 data is stored
 base_dir = "/media/eouser/..."
@@ -14,36 +15,35 @@ bands = ["B04_20m", "B11_20m", "B12_20m"]
 
 # Extent of our choice
 common_extent = (3769660, 2336620, 5109780, 3489900)
+resolution = 20
+
+# Index of the band rasters; only files that changed since the last run are read
+catalog_path = os.path.join(base_dir, "catalog.sqlite")
+# Or take the rasters of a band from a text file with one path per line instead of the catalog
+# ({band} and, with per_year, {year} are filled in, e.g. "/media/eouser/.../lists/{year}_{band}.txt")
+list_file = None
+
+# One VRT per band and year (B04_2017_20m.vrt, ...) or, with per_year = False, one per band over
+# all years as before (B04_20m.vrt)
+per_year = True
+vrt_workers = 4
 
-# Directory to store fixed VRTs
+# Directory to store fixed VRTs; vrt_manifest.json there lists them for gdal2h5.py
 vrt_output_dir = os.path.join(base_dir, "vrt")
-os.makedirs(vrt_output_dir, exist_ok=True)
-
-for band in bands:
-    all_rasters = []
-    for year in years:
-        band_dir = os.path.join(base_dir, str(year), band)
-        if os.path.exists(band_dir):
-            all_rasters.extend(glob.glob(os.path.join(band_dir, "*.tif")))
-    
-    if not all_rasters:
-        print(f"No rasters found for band {band}, skipping.")
-        continue
-
-    vrt_path = os.path.join(vrt_output_dir, f"{band}.vrt")
-    cmd = [
-        "gdalbuildvrt",
-        "-resolution", "user",
-        "-tr", "20", "20",
-        "-te",
-        str(common_extent[0]),
-        str(common_extent[1]),
-        str(common_extent[2]),
-        str(common_extent[3]),
-        "-overwrite",
-        vrt_path
-    ] + all_rasters
-
-    print("Running command:", " ".join(cmd))
-    subprocess.run(cmd, check=True)
-    print(f"Created VRT: {vrt_path}")
+
+if list_file and per_year and "{year}" in list_file:
+    jobs = [(band, year, list_file_records(list_file.format(band=band, year=year))) for band in bands for year in years
+            if os.path.exists(list_file.format(band=band, year=year))]
+elif list_file:
+    jobs = [(band, None, list_file_records(list_file.format(band=band))) for band in bands]
+else:
+    catalog = RasterCatalog(catalog_path)
+    catalog.refresh(base_dir, years, bands)
+    if per_year:
+        jobs = [(band, year, catalog.records(band, [year])) for band in bands for year in years]
+    else:
+        jobs = [(band, None, catalog.records(band, years)) for band in bands]
+    catalog.close()
+
+manifest_path = build_vrts(jobs, vrt_output_dir, common_extent, resolution, workers=vrt_workers)
+print(f"Wrote {manifest_path}")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Alen Mangafić
+"""
+import json
+import asyncio
+import sqlite3
+import hashlib
+from datetime import datetime, timezone
+import aiohttp
+
+# Async STAC search: the request for page n+1 is in flight while page n is stored, and items land
+# in a SQLite cache (one row per item id) that scene selection queries instead of re-searching.
+
+def search_key(url, query):
+    """Cache key of a search: the endpoint and its canonical JSON body."""
+    return hashlib.sha256(json.dumps([url, query], sort_keys=True).encode()).hexdigest()
+
+def item_tile(item):
+    """MGRS tile of a Sentinel-2 item, e.g. 'T33TVM' (from the product id, as before, or the grid properties)."""
+    parts = item.get("id", "").split('_')
+    if len(parts) >= 3 and parts[-2].startswith("T"):
+        return parts[-2]
+    properties = item.get("properties", {})
+    code = properties.get("grid:code") or properties.get("s2:mgrs_tile") or properties.get("mgrs:tile")
+    return f"T{code.split('-')[-1]}" if code else None
+
+def _next_request(page, body):
+    """(href, POST body or None) of the page's 'next' link, or None on the last page."""
+    link = next((link for link in page.get("links", []) if link.get("rel") == "next"), None)
+    if link is None:
+        return None
+    if link.get("method", "GET").upper() == "POST":
+        next_body = dict(body, **link.get("body", {})) if link.get("merge") else link.get("body", body)
+        return link["href"], next_body
+    return link["href"], None
+
+async def _fetch_page(session, href, body):
+    if body is not None:
+        async with session.post(href, json=body) as response:
+            response.raise_for_status()
+            return await response.json()
+    async with session.get(href) as response:
+        response.raise_for_status()
+        return await response.json()
+
+async def search_pages(url, query, session):
+    """Yields the result pages of a STAC search, with the next page already requested."""
+    task = asyncio.create_task(_fetch_page(session, url, query))
+    while task is not None:
+        page = await task
+        request = _next_request(page, query)
+        task = asyncio.create_task(_fetch_page(session, *request)) if request else None
+        # let the next request go out before the caller starts working on this page
+        await asyncio.sleep(0)
+        yield page
+
+class StacCache:
+    """SQLite store of STAC items (indexed by tile, datetime and cloud cover) and of completed searches."""
+
+    def __init__(self, path):
+        # used from one thread at a time: the caller, or asyncio.to_thread while a page is stored
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                id TEXT PRIMARY KEY, collection TEXT, tile TEXT, datetime TEXT, cloud_cover REAL, item TEXT);
+            CREATE INDEX IF NOT EXISTS items_tile ON items (tile);
+            CREATE INDEX IF NOT EXISTS items_datetime ON items (datetime);
+            CREATE INDEX IF NOT EXISTS items_cloud_cover ON items (cloud_cover);
+            CREATE TABLE IF NOT EXISTS assets (
+                item_id TEXT, name TEXT, href TEXT, size INTEGER, PRIMARY KEY (item_id, name));
+            CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, query TEXT, fetched TEXT, items INTEGER);
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def add_items(self, items):
+        """Inserts or replaces items (deduplicated by id) with their assets."""
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)",
+                [(item["id"], item.get("collection"), item_tile(item), item.get("properties", {}).get("datetime"),
+                  item.get("properties", {}).get("eo:cloud_cover"), json.dumps(item)) for item in items])
+            self.db.executemany("DELETE FROM assets WHERE item_id = ?", [(item["id"],) for item in items])
+            self.db.executemany(
+                "INSERT INTO assets VALUES (?, ?, ?, ?)",
+                [(item["id"], name, asset.get("href"), asset.get("file:size", 0))
+                 for item in items for name, asset in item.get("assets", {}).items()])
+        return len(items)
+
+    def has_search(self, key, max_age_days=None):
+        row = self.db.execute("SELECT fetched FROM searches WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        if max_age_days is None:
+            return True
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(row[0])
+        return age.total_seconds() < max_age_days * 86400
+
+    def record_search(self, key, query, n_items):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)",
+                            (key, json.dumps(query), datetime.now(timezone.utc).isoformat(), n_items))
+
+    def select_scenes(self, bands, start, end, max_cloud_cover=None, collection=None):
+        """
+        The largest scene per tile (summed file:size of `bands`, as before) among the items with
+        start <= datetime < end, below max_cloud_cover: {tile: {'id', 'size', 'assets': {band: {'href', 'file:size'}}}}.
+        """
+        conditions, params = ["i.datetime >= ?", "i.datetime < ?"], [start, end]
+        if max_cloud_cover is not None:
+            conditions.append("i.cloud_cover < ?")
+            params.append(max_cloud_cover)
+        if collection is not None:
+            conditions.append("i.collection = ?")
+            params.append(collection)
+        band_marks = ", ".join("?" * len(bands))
+        rows = self.db.execute(f"""
+            WITH sized AS (
+                SELECT i.id, i.tile, SUM(a.size) AS size
+                FROM items i JOIN assets a ON a.item_id = i.id AND a.name IN ({band_marks})
+                WHERE i.tile IS NOT NULL AND {' AND '.join(conditions)}
+                GROUP BY i.id)
+            SELECT s.tile, s.id, s.size, a.name, a.href, a.size FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY tile ORDER BY size DESC, id) AS rank FROM sized) s
+            JOIN assets a ON a.item_id = s.id AND a.name IN ({band_marks})
+            WHERE s.rank = 1
+            ORDER BY s.tile""", [*bands, *params, *bands]).fetchall()
+        scenes = {}
+        for tile, item_id, size, band, href, band_size in rows:
+            scene = scenes.setdefault(tile, {"id": item_id, "size": size, "assets": {}})
+            scene["assets"][band] = {"href": href, "file:size": band_size}
+        return scenes
+
+    def candidate_scenes(self, bands, start, end, max_cloud_cover=None, collection=None, limit=None):
+        """
+        Up to `limit` scenes per tile for compositing, least cloudy first, with the same filters as
+        select_scenes: {tile: [{'id', 'cloud_cover', 'assets': {band: {'href', 'file:size'}}}, ...]}.
+        """
+        conditions, params = ["i.datetime >= ?", "i.datetime < ?"], [start, end]
+        if max_cloud_cover is not None:
+            conditions.append("i.cloud_cover < ?")
+            params.append(max_cloud_cover)
+        if collection is not None:
+            conditions.append("i.collection = ?")
+            params.append(collection)
+        band_marks = ", ".join("?" * len(bands))
+        rows = self.db.execute(f"""
+            WITH ranked AS (
+                SELECT i.id, i.tile, i.cloud_cover,
+                       ROW_NUMBER() OVER (PARTITION BY i.tile ORDER BY i.cloud_cover, i.datetime, i.id) AS rank
+                FROM items i
+                WHERE i.tile IS NOT NULL AND {' AND '.join(conditions)}
+                  AND EXISTS (SELECT 1 FROM assets a WHERE a.item_id = i.id AND a.name IN ({band_marks})))
+            SELECT r.tile, r.id, r.cloud_cover, a.name, a.href, a.size FROM ranked r
+            JOIN assets a ON a.item_id = r.id AND a.name IN ({band_marks})
+            WHERE ? IS NULL OR r.rank <= ?
+            ORDER BY r.tile, r.rank""", [*params, *bands, *bands, limit, limit]).fetchall()
+        scenes = {}
+        for tile, item_id, cloud_cover, band, href, band_size in rows:
+            candidates = scenes.setdefault(tile, [])
+            if not candidates or candidates[-1]["id"] != item_id:
+                candidates.append({"id": item_id, "cloud_cover": cloud_cover, "assets": {}})
+            candidates[-1]["assets"][band] = {"href": href, "file:size": band_size}
+        return scenes
+
+async def fetch_search(url, query, cache, session=None):
+    """Runs a STAC search into the cache, storing each page while the next one downloads; returns the item count."""
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession()
+    try:
+        n_items = 0
+        async for page in search_pages(url, query, session):
+            n_items += await asyncio.to_thread(cache.add_items, page.get("features", []))
+        cache.record_search(search_key(url, query), query, n_items)
+        return n_items
+    finally:
+        if own_session:
+            await session.close()
+
+def cached_search(url, query, cache, refresh=False, max_age_days=None):
+    """Fetches a search unless the cache already holds it (and it is younger than max_age_days)."""
+    key = search_key(url, query)
+    if not refresh and cache.has_search(key, max_age_days):
+        return None
+    return asyncio.run(fetch_search(url, query, cache))
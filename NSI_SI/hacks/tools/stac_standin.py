@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Alen Mangafić
+"""
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the STAC /search endpoint, to run s2_fetch/stac_client without the network:
+# POST /search filters the served items by datetime and eo:cloud_cover and pages them with
+# GET 'next' links; `delay` adds latency per page.
+
+def synthetic_items(n_items, year=2023, n_tiles=40, bands=('B12_20m', 'B11_20m', 'B04_20m'), seed=0):
+    """Sentinel-2 L2A-like items: several scenes per MGRS tile in May, random cloud cover and asset sizes."""
+    rng = np.random.default_rng(seed)
+    tiles = [f"T{31 + i % 4}U{'ABCDEFGH'[i // 4 % 8]}{'PQRSTUVW'[i // 32 % 8]}" for i in range(n_tiles)]
+    items = []
+    for i in range(n_items):
+        tile = tiles[i % n_tiles]
+        when = datetime(year, 5, 1, 10, 30) + timedelta(days=int(rng.integers(0, 31)), seconds=i)
+        stamp = when.strftime("%Y%m%dT%H%M%S")
+        item_id = f"S2B_MSIL2A_{stamp}_N0509_R{i % 143:03d}_{tile}_{stamp}"
+        items.append({
+            "type": "Feature", "stac_version": "1.0.0", "id": item_id, "collection": "sentinel-2-l2a",
+            "properties": {"datetime": when.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                           "eo:cloud_cover": round(float(rng.uniform(0, 20)), 2)},
+            "assets": {band: {"href": f"s3://EODATA/Sentinel-2/MSI/L2A/{year}/{item_id}/{band}.jp2",
+                              "file:size": int(rng.integers(1e6, 3e7))} for band in bands},
+            "links": [],
+        })
+    return items
+
+def _matches(item, body):
+    properties = item["properties"]
+    if "datetime" in body:
+        start, _, end = body["datetime"].partition("/")
+        if not (start[:19] <= properties["datetime"][:19] <= (end or start)[:19]):
+            return False
+    if body.get("collections") and item.get("collection") not in body["collections"]:
+        return False
+    for op, value in body.get("query", {}).get("eo:cloud_cover", {}).items():
+        cloud = properties.get("eo:cloud_cover")
+        if not {"lt": cloud < value, "lte": cloud <= value, "gt": cloud > value,
+                "gte": cloud >= value, "eq": cloud == value}.get(op, True):
+            return False
+    return True
+
+def make_handler(items, delay=0.0):
+    searches = {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def _page(self, search_id, offset):
+            time.sleep(delay)
+            matched, limit = searches[search_id]
+            page = matched[offset:offset + limit]
+            links = []
+            if offset + limit < len(matched):
+                host = self.headers.get("Host")
+                links.append({"rel": "next", "type": "application/geo+json", "method": "GET",
+                              "href": f"http://{host}/search?search={search_id}&offset={offset + limit}"})
+            body = json.dumps({"type": "FeatureCollection", "features": page, "links": links,
+                               "context": {"returned": len(page), "matched": len(matched)}}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/geo+json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            with lock:
+                search_id = str(len(searches))
+                searches[search_id] = ([item for item in items if _matches(item, body)], min(int(body.get("limit", 10)), 1000))
+            self._page(search_id, 0)
+
+        def do_GET(self):
+            params = parse_qs(urlparse(self.path).query)
+            if "search" not in params or params["search"][0] not in searches:
+                self.send_error(404)
+                return
+            self._page(params["search"][0], int(params.get("offset", ["0"])[0]))
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def serve(items, port=0, delay=0.0):
+    """Starts the stand-in in a background thread; returns (server, search URL). Stop with server.shutdown()."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(items, delay))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/search"
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve STAC items from a JSON file (or synthetic ones) as a local /search endpoint.")
+    parser.add_argument("--items", help="JSON file with a list of items or a FeatureCollection")
+    parser.add_argument("--synthetic", type=int, default=2000, help="number of synthetic items without --items")
+    parser.add_argument("--port", type=int, default=8085)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds of latency per page")
+    args = parser.parse_args()
+
+    if args.items:
+        with open(args.items) as f:
+            items = json.load(f)
+        items = items.get("features", items) if isinstance(items, dict) else items
+    else:
+        items = synthetic_items(args.synthetic)
+    server, url = serve(items, args.port, args.delay)
+    print(f"Serving {len(items)} items at {url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
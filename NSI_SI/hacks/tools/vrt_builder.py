@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Alen Mangafić
+"""
+import os
+import json
+import argparse
+import concurrent.futures
+from xml.sax.saxutils import escape
+import rasterio
+from rasterio.crs import CRS
+from rasterio.dtypes import dtype_rev, typename_fwd
+
+from raster_catalog import COLUMNS, raster_metadata
+
+# In-process replacement for `gdalbuildvrt -resolution user -tr RES RES -te COMMON_EXTENT`: the
+# mosaic VRT is written directly from the source footprints (from the raster catalog, or read from
+# a list file), so there is no command line to overflow and no subprocess per VRT. Every source is
+# checked against the common grid on the way; sources off the grid are still placed (and resampled
+# by GDAL on read, as gdalbuildvrt would) but reported, sources in another CRS are left out.
+
+def list_file_records(list_file, workers=8):
+    """Catalog-like records of the rasters named in a text file, one path per line."""
+    with open(list_file) as f:
+        paths = [line.strip() for line in f if line.strip()]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        metadata = list(executor.map(raster_metadata, paths))
+    return [dict(zip(COLUMNS[:1] + COLUMNS[7:], (path, *meta))) for path, meta in zip(paths, metadata)]
+
+def grid_offset(record, common_extent, resolution):
+    """(col, row, width, height) of a source on the common grid, in (possibly fractional) grid pixels."""
+    xmin, _, _, ymax = common_extent
+    return ((record["left"] - xmin) / resolution, (ymax - record["top"]) / resolution,
+            (record["right"] - record["left"]) / resolution, (record["top"] - record["bottom"]) / resolution)
+
+def is_aligned(record, common_extent, resolution, tolerance=1e-6):
+    if abs(record["xres"] - resolution) > tolerance or abs(record["yres"] - resolution) > tolerance:
+        return False
+    return all(abs(value - round(value)) <= tolerance for value in grid_offset(record, common_extent, resolution))
+
+def source_properties(path):
+    """(GDAL data type, nodata, block height, block width) of the first band of a raster."""
+    with rasterio.open(path) as src:
+        block_height, block_width = src.block_shapes[0]
+        return typename_fwd[dtype_rev[src.dtypes[0]]], src.nodata, block_height, block_width
+
+def build_vrt(vrt_path, records, common_extent, resolution, crs="EPSG:3035", workers=8):
+    """
+    Writes a mosaic VRT of `records` (later ones on top, as with gdalbuildvrt) over common_extent at
+    `resolution`. Returns a summary {'path', 'sources', 'misaligned': [paths], 'skipped': [paths]}.
+    """
+    xmin, ymin, xmax, ymax = common_extent
+    width, height = int(round((xmax - xmin) / resolution)), int(round((ymax - ymin) / resolution))
+    crs = CRS.from_user_input(crs)
+    sources, misaligned, skipped = [], [], []
+    for record in records:
+        outside = record["right"] <= xmin or record["left"] >= xmax or record["top"] <= ymin or record["bottom"] >= ymax
+        if outside or record["crs"] is None or CRS.from_user_input(record["crs"]) != crs:
+            skipped.append(record["path"])
+            continue
+        if not is_aligned(record, common_extent, resolution):
+            misaligned.append(record["path"])
+        sources.append(record)
+    summary = {"path": vrt_path, "sources": len(sources), "misaligned": misaligned, "skipped": skipped}
+    if not sources:
+        return summary
+
+    # every source's own data type and block size go into its SourceProperties; data type and
+    # nodata of the mosaic come from the first source, as gdalbuildvrt does
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        properties = list(executor.map(source_properties, [record["path"] for record in sources]))
+    dtype, nodata = properties[0][:2]
+    nodata_xml = f"      <NODATA>{nodata:g}</NODATA>\n" if nodata is not None else ""
+    lines = [
+        f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+        f"  <SRS>{escape(crs.to_wkt())}</SRS>",
+        f"  <GeoTransform>{xmin!r}, {resolution!r}, 0, {ymax!r}, 0, {-resolution!r}</GeoTransform>",
+        f'  <VRTRasterBand dataType="{dtype}" band="1">',
+    ]
+    if nodata is not None:
+        lines.append(f"    <NoDataValue>{nodata:g}</NoDataValue>")
+    for record, (source_dtype, _, block_height, block_width) in zip(sources, properties):
+        col, row, dst_width, dst_height = grid_offset(record, common_extent, resolution)
+        lines.append(
+            f"    <{'ComplexSource' if nodata is not None else 'SimpleSource'}>\n"
+            f'      <SourceFilename relativeToVRT="0">{escape(record["path"])}</SourceFilename>\n'
+            f"      <SourceBand>1</SourceBand>\n"
+            f'      <SourceProperties RasterXSize="{record["width"]}" RasterYSize="{record["height"]}" '
+            f'DataType="{source_dtype}" BlockXSize="{block_width}" BlockYSize="{block_height}" />\n'
+            f'      <SrcRect xOff="0" yOff="0" xSize="{record["width"]}" ySize="{record["height"]}" />\n'
+            f'      <DstRect xOff="{col:.10g}" yOff="{row:.10g}" xSize="{dst_width:.10g}" ySize="{dst_height:.10g}" />\n'
+            f"{nodata_xml}"
+            f"    </{'ComplexSource' if nodata is not None else 'SimpleSource'}>")
+    lines += ["  </VRTRasterBand>", "</VRTDataset>", ""]
+
+    os.makedirs(os.path.dirname(os.path.abspath(vrt_path)), exist_ok=True)
+    part_path = f"{vrt_path}.part"
+    with open(part_path, "w") as f:
+        f.write("\n".join(lines))
+    os.replace(part_path, vrt_path)
+    return summary
+
+def vrt_name(band, year=None):
+    """B04_20m, 2017 -> B04_2017_20m.vrt (the band-year naming gdal2h5.py parses); B04_20m -> B04_20m.vrt."""
+    if year is None:
+        return f"{band}.vrt"
+    name, _, suffix = band.partition("_")
+    return f"{name}_{year}_{suffix}.vrt" if suffix else f"{band}_{year}.vrt"
+
+def build_vrts(jobs, vrt_output_dir, common_extent, resolution, crs="EPSG:3035", workers=4):
+    """
+    Builds the VRTs of [(band, year or None, records)] in parallel and writes vrt_manifest.json
+    next to them (read by gdal2h5.py). Returns the manifest path.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(band, year, executor.submit(build_vrt, os.path.join(vrt_output_dir, vrt_name(band, year)),
+                                                records, common_extent, resolution, crs))
+                   for band, year, records in jobs]
+        vrts = []
+        for band, year, future in futures:
+            summary = future.result()
+            if not summary["sources"]:
+                print(f"No rasters for {band} {year or ''}, skipping.")
+                continue
+            print(f"Created VRT: {summary['path']} ({summary['sources']} rasters)")
+            if summary["misaligned"]:
+                print(f"Warning: {len(summary['misaligned'])} rasters of {summary['path']} are off the common grid, e.g. {summary['misaligned'][0]}")
+            if summary["skipped"]:
+                print(f"Warning: left {len(summary['skipped'])} rasters out of {summary['path']} (other CRS or outside the extent)")
+            vrts.append({"band": band, "year": year, **summary})
+
+    manifest = {"common_extent": list(common_extent), "resolution": resolution,
+                "crs": CRS.from_user_input(crs).to_string(), "vrts": vrts}
+    manifest_path = os.path.join(vrt_output_dir, "vrt_manifest.json")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a mosaic VRT on the common grid from a list of rasters.")
+    parser.add_argument("list_file", help="text file with one raster path per line")
+    parser.add_argument("vrt_path")
+    parser.add_argument("--extent", type=float, nargs=4, default=(3769660, 2336620, 5109780, 3489900),
+                        metavar=("XMIN", "YMIN", "XMAX", "YMAX"))
+    parser.add_argument("--resolution", type=float, default=20)
+    parser.add_argument("--crs", default="EPSG:3035")
+    args = parser.parse_args()
+
+    summary = build_vrt(args.vrt_path, list_file_records(args.list_file), tuple(args.extent), args.resolution, args.crs)
+    print(f"Created VRT: {args.vrt_path} ({summary['sources']} rasters, {len(summary['misaligned'])} off the grid, "
+          f"{len(summary['skipped'])} left out)")
+
+if __name__ == "__main__":
+    main()
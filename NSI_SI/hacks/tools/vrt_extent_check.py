@@ -3,29 +3,22 @@
 """
 @author: Alen Mangafić
 """
-import os
-import rasterio
+from raster_catalog import RasterCatalog
 
 bands_directory = "/media/eouser/.../s2/vrt"
+# Bounds of the VRTs come from the catalog; a VRT is only opened again when it changed
+catalog_path = "/media/eouser/.../s2/catalog.sqlite"
 
-# Gather all .vrt files
-vrt_files = [
-    os.path.join(bands_directory, f)
-    for f in os.listdir(bands_directory)
-    if f.endswith(".vrt")
-]
-
-extents = []
-for vrt_path in vrt_files:
-    with rasterio.open(vrt_path) as src:
-        extents.append((vrt_path, src.bounds))
+catalog = RasterCatalog(catalog_path)
+catalog.refresh_directory(bands_directory, extensions=(".vrt",))
+extents = catalog.extents(bands_directory)
+catalog.close()
 
 # Check if all extents match
-unique_bounds = set(bounds for _, bounds in extents)
-
-if len(unique_bounds) == 1:
-    print("All VRT files have the SAME extent:", unique_bounds.pop())
+if len(extents) == 1:
+    print("All VRT files have the SAME extent:", next(iter(extents)))
 else:
     print("VRT files have DIFFERENT extents:")
-    for path, bounds in extents:
-        print(f"{path} → {bounds}")
+    for bounds, paths in extents.items():
+        for path in paths:
+            print(f"{path} → {bounds}")
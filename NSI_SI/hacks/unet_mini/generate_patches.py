@@ -1,8 +1,81 @@
+import os
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from sklearn.model_selection import train_test_split
 from grass.script import array as garray
 
-def generate_patches(feature_layers, label_layer, patch_size, overlap, split_ratios, binary_labels=False):
+def patch_views(array, patch_size, overlap):
+    """
+    Strided (rows, cols, patch, patch[, C]) view of the patches of a 2-D or (H, W, C) array, on the
+    same origins as the old nested loops; no data is copied. Empty if the array is smaller than a
+    patch, where the old loops found no patches either.
+    """
+    step = patch_size - overlap
+    if array.shape[0] < patch_size or array.shape[1] < patch_size:
+        return np.empty((0, 0, patch_size, patch_size) + array.shape[2:], dtype=array.dtype)
+    view = sliding_window_view(array, (patch_size, patch_size), axis=(0, 1))
+    view = view[:array.shape[0] - patch_size:step, :array.shape[1] - patch_size:step]
+    return np.moveaxis(view, 2, -1) if array.ndim == 3 else view
+
+def patch_origins(labels, patch_size, overlap, binary_labels=False):
+    """(N, 2) array of the (row, col) origins of the patches with more than one label class."""
+    view = patch_views(labels, patch_size, overlap)
+    lowest, highest = view.min(axis=(2, 3)), view.max(axis=(2, 3))
+    # binary labels are label > 0, so a patch is mixed if it has both a label <= 0 and one > 0
+    mixed = (lowest <= 0) & (highest > 0) if binary_labels else lowest != highest
+    step = patch_size - overlap
+    return np.argwhere(mixed) * step
+
+def patch_means(labels, origins, patch_size, binary_labels=False):
+    """Mean label of every patch (from a summed-area table), the old stratification key."""
+    values = (labels > 0) if binary_labels else labels
+    table = np.zeros((labels.shape[0] + 1, labels.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(values, axis=0, dtype=np.int64), axis=1, out=table[1:, 1:])
+    rows, cols = origins[:, 0], origins[:, 1]
+    sums = (table[rows + patch_size, cols + patch_size] - table[rows, cols + patch_size]
+            - table[rows + patch_size, cols] + table[rows, cols])
+    return sums / patch_size ** 2
+
+def extract_patches(array, origins, patch_size, out=None, batch_size=256):
+    """
+    Copies the patches at `origins` into `out` (a preallocated array or memmap of shape
+    (N, patch, patch[, C]); a new array if None), batch_size patches at a time.
+    """
+    if out is None:
+        out = np.empty((len(origins), patch_size, patch_size) + array.shape[2:], dtype=array.dtype)
+    view = sliding_window_view(array, (patch_size, patch_size), axis=(0, 1))
+    for start in range(0, len(origins), batch_size):
+        rows, cols = origins[start:start + batch_size].T
+        batch = view[rows, cols]
+        out[start:start + len(batch)] = np.moveaxis(batch, 1, -1) if array.ndim == 3 else batch
+    return out
+
+def iter_patches(features, labels, origins, patch_size, batch_size=256, binary_labels=False):
+    """Yields (feature patches, label patches) batches of the patches at `origins`, copying only one batch at a time."""
+    for start in range(0, len(origins), batch_size):
+        batch = origins[start:start + batch_size]
+        label_batch = extract_patches(labels, batch, patch_size)
+        if binary_labels:
+            label_batch = (label_batch > 0).astype(np.uint8)
+        yield extract_patches(features, batch, patch_size), label_batch
+
+def materialize(features, labels, origins, patch_size, binary_labels=False, memmap_path=None):
+    """Feature and label patches at `origins` as arrays, or as .npy memmaps at memmap_path + _x.npy/_y.npy."""
+    label_dtype = np.uint8 if binary_labels else labels.dtype
+    x_shape = (len(origins), patch_size, patch_size, features.shape[2])
+    y_shape = (len(origins), patch_size, patch_size)
+    if memmap_path is None:
+        x, y = np.empty(x_shape, features.dtype), np.empty(y_shape, label_dtype)
+    else:
+        x = np.lib.format.open_memmap(f"{memmap_path}_x.npy", mode="w+", dtype=features.dtype, shape=x_shape)
+        y = np.lib.format.open_memmap(f"{memmap_path}_y.npy", mode="w+", dtype=label_dtype, shape=y_shape)
+    start = 0
+    for x_batch, y_batch in iter_patches(features, labels, origins, patch_size, binary_labels=binary_labels):
+        x[start:start + len(x_batch)], y[start:start + len(y_batch)] = x_batch, y_batch
+        start += len(x_batch)
+    return x, y
+
+def generate_patches(feature_layers, label_layer, patch_size, overlap, split_ratios, binary_labels=False, memmap_dir=None):
     print(f"Loading features: {feature_layers}")
     features = np.stack([garray.array(layer)[:] for layer in feature_layers], axis=-1)
 
@@ -16,27 +89,21 @@ def generate_patches(feature_layers, label_layer, patch_size, overlap, split_rat
         print("Label array is empty.")
         return None
 
-    patches, label_patches = [], []
-    for y in range(0, labels.shape[0] - patch_size, patch_size - overlap):
-        for x in range(0, labels.shape[1] - patch_size, patch_size - overlap):
-            patch = features[y:y + patch_size, x:x + patch_size, :]
-            label_patch = labels[y:y + patch_size, x:x + patch_size]
-
-            if binary_labels:
-                label_patch = (label_patch > 0).astype(np.uint8)
-
-            if len(np.unique(label_patch)) > 1:
-                patches.append(patch)
-                label_patches.append(label_patch)
-
-    patches, label_patches = np.array(patches), np.array(label_patches)
-    if len(patches) == 0:
+    origins = patch_origins(labels, patch_size, overlap, binary_labels)
+    if len(origins) == 0:
         print("No valid patches found.")
         return None
 
-    train_x, valid_x, train_y, valid_y = train_test_split(
-        patches, label_patches, test_size=split_ratios[1], stratify=[p.flatten().mean() for p in label_patches]
+    # split the patch origins, then copy each split once (into memmaps under memmap_dir, if given)
+    train_origins, valid_origins = train_test_split(
+        origins, test_size=split_ratios[1], stratify=patch_means(labels, origins, patch_size, binary_labels)
     )
+    if memmap_dir is not None:
+        os.makedirs(memmap_dir, exist_ok=True)
+    splits = {}
+    for name, split_origins in (("train", train_origins), ("valid", valid_origins)):
+        memmap_path = os.path.join(memmap_dir, name) if memmap_dir is not None else None
+        splits[name] = materialize(features, labels, split_origins, patch_size, binary_labels, memmap_path)
 
-    return {"train": (train_x, train_y), "valid": (valid_x, valid_y), "label_name": "labels_2017"}
-
+    return {"train": splits["train"], "valid": splits["valid"], "label_name": "labels_2017",
+            "origins": {"train": train_origins, "valid": valid_origins}}
@@ -0,0 +1,131 @@
+import math
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import numpy as np
+from h5_tiles import feature_source, feature_shape, label_dataset, read_feature_tile, read_label_tile, useful_tiles
+
+# Streaming training input from ard.h5: tiles are read when they are needed instead of loading
+# the training area into memory. Decode threads (each with its own h5py.File) read the tiles of the
+# next batches while a producer thread assembles batches into a bounded queue, so up to `prefetch`
+# batches are ready while the model trains on the current one.
+
+def tile_rows(h5_file_path, feature_layers, row_chunks, tile_size, min_valid=0.0):
+    """(row_start, col_start) of every useful tile in the given tile rows, across the full width."""
+    with h5py.File(h5_file_path, "r") as h5file:
+        source = feature_source(h5file, feature_layers)
+        _, cols = feature_shape(source)
+        tiles = [(row * tile_size, col) for row in row_chunks for col in range(0, cols, tile_size)]
+        return useful_tiles(h5file, source, tile_size, tiles, min_valid=min_valid)
+
+class H5TileStream:
+    """
+    Endless iterator of (features, labels) batches over `tiles` of ard.h5, reshuffled every epoch
+    (shuffle=False keeps the tile order, e.g. for validation). len() is the number of batches per
+    epoch, for steps_per_epoch/validation_steps.
+    """
+
+    def __init__(self, h5_file_path, feature_layers, tiles, tile_size, batch_size, shuffle=True,
+                 workers=4, prefetch=4, seed=None):
+        self.h5_file_path = h5_file_path
+        self.feature_layers = feature_layers
+        self.tiles = np.asarray(tiles, dtype=np.int64).reshape(-1, 2)
+        self.tile_size = tile_size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.workers = workers
+        self.prefetch = prefetch
+        self.rng = np.random.default_rng(seed)
+        self._local = threading.local()
+        self._handles = []
+        self._handles_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.input_shape = (tile_size, tile_size, len(feature_layers))
+        with h5py.File(h5_file_path, "r") as h5file:
+            self.label_dtype = label_dataset(h5file).dtype
+
+    def __len__(self):
+        return math.ceil(len(self.tiles) / self.batch_size)
+
+    def _reader(self):
+        """(feature source, label dataset) of this thread's own h5py.File."""
+        reader = getattr(self._local, "reader", None)
+        if reader is None:
+            h5file = h5py.File(self.h5_file_path, "r")
+            with self._handles_lock:
+                self._handles.append(h5file)
+            reader = self._local.reader = (feature_source(h5file, self.feature_layers), label_dataset(h5file))
+        return reader
+
+    def _read(self, row_start, col_start):
+        source, label_dset = self._reader()
+        return (read_feature_tile(source, row_start, col_start, self.tile_size),
+                read_label_tile(label_dset, row_start, col_start, self.tile_size))
+
+    def _batch_tiles(self):
+        """Tile origins of consecutive batches, epoch after epoch, in a new order every epoch."""
+        while True:
+            order = self.tiles[self.rng.permutation(len(self.tiles))] if self.shuffle else self.tiles
+            for start in range(0, len(order), self.batch_size):
+                yield order[start:start + self.batch_size]
+
+    def _put(self, batches, item):
+        """Blocks until the queue takes item; False if the stream was stopped meanwhile."""
+        while not self._stop.is_set():
+            try:
+                batches.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, batches):
+        """Keeps prefetch batches' worth of tile reads in flight and queues the batches in order."""
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = deque()
+                for batch_tiles in self._batch_tiles():
+                    if self._stop.is_set():
+                        break
+                    pending.append([executor.submit(self._read, row, col) for row, col in batch_tiles])
+                    if len(pending) <= self.prefetch:
+                        continue
+                    futures = pending.popleft()
+                    features = np.empty((len(futures),) + self.input_shape, dtype=np.float32)
+                    labels = np.empty((len(futures), self.tile_size, self.tile_size), dtype=self.label_dtype)
+                    for i, future in enumerate(futures):
+                        features[i], labels[i] = future.result()
+                    if not self._put(batches, (features, labels)):
+                        break
+                for futures in pending:
+                    for future in futures:
+                        future.cancel()
+        except Exception as e:
+            self._put(batches, e)
+        finally:
+            self._close_handles()
+
+    def __iter__(self):
+        if not len(self.tiles):
+            raise ValueError("No tiles to stream")
+        self._stop.clear()
+        batches = queue.Queue(maxsize=self.prefetch)
+        producer = threading.Thread(target=self._produce, args=(batches,), daemon=True)
+        producer.start()
+        try:
+            while True:
+                batch = batches.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            self._stop.set()
+            producer.join()
+
+    def _close_handles(self):
+        with self._handles_lock:
+            for h5file in self._handles:
+                h5file.close()
+            self._handles.clear()
@@ -0,0 +1,148 @@
+import os
+import zlib
+import numpy as np
+
+try:
+    import hdf5plugin  # registers the Blosc/Zstd filters for files written with compression "blosc-zstd"
+except ImportError:
+    hdf5plugin = None
+
+# Tile reads from ard.h5 in either layout written by tools/gdal2h5.py:
+# "bands": one 2-D dataset per band (/features/{layer}), stacked here for every tile;
+# "interleaved": one (H, W, C) dataset per year (features/{year}) with band order in its
+# "band_names" attribute, so a tile is a single chunk read.
+# Compact feature storage (uint16 with a "nodata" attribute, or float16 with a "scale_factor") is
+# turned back into float32 with NaN per tile, after the read.
+# The tile index (tile_index/<dataset>) lets loops skip empty tiles, see useful_tiles.
+# gzip tiles on the chunk grid are read raw and inflated with zlib outside h5py's global lock, so
+# several reader threads (h5_dataset.py) decode in parallel.
+
+def is_interleaved(h5file):
+    return h5file.attrs.get("layout") == "interleaved"
+
+def _band_index(band_names, layer):
+    key = os.path.splitext(layer)[0]
+    for i, band in enumerate(band_names):
+        if key == band or key.startswith(f"{band}_"):
+            return i
+    return None
+
+def feature_source(h5file, feature_layers):
+    """
+    Resolves feature layers to what the tile readers need: a list of 2-D datasets (band layout) or
+    (dataset, band indices) for the interleaved layout. Layers are given as before ('B04_20m.vrt'),
+    optionally prefixed by the year dataset to use ('2018/B04_20m.vrt'); without a prefix the first
+    year holding all requested bands is used.
+    """
+    if not is_interleaved(h5file):
+        return [h5file[f"/features/{layer}"] for layer in feature_layers]
+
+    years = {layer.rpartition("/")[0] for layer in feature_layers}
+    if len(years) > 1:
+        raise ValueError(f"Feature layers span several years: {sorted(years)}")
+    year = years.pop()
+    for name in ([year] if year else sorted(h5file["features"])):
+        dset = h5file["features"][name]
+        band_names = [b.decode() if isinstance(b, bytes) else str(b) for b in dset.attrs["band_names"]]
+        indices = [_band_index(band_names, layer.rpartition("/")[2]) for layer in feature_layers]
+        if None not in indices:
+            return dset, indices
+    raise KeyError(f"No interleaved features dataset holds {feature_layers}")
+
+def feature_shape(source):
+    """(rows, cols) of a feature source."""
+    dset = source[0]
+    return dset.shape[:2]
+
+def decode_features(data, attrs):
+    """Stored feature values -> float32 with NaN, following the nodata/scale_factor attributes."""
+    if "nodata" in attrs:
+        nodata = data == attrs["nodata"]
+        data = data.astype(np.float32)
+        data[nodata] = np.nan
+    else:
+        data = data.astype(np.float32, copy=False)
+    if "scale_factor" in attrs:
+        data *= np.float32(attrs["scale_factor"])
+    return data
+
+def _pad(data, tile_size):
+    if data.shape[:2] == (tile_size, tile_size):
+        return data
+    pad = [(0, tile_size - data.shape[0]), (0, tile_size - data.shape[1])] + [(0, 0)] * (data.ndim - 2)
+    return np.pad(data, pad, mode="constant")
+
+def _direct_chunks(dset, tile_size):
+    """True if the tiles of dset are whole gzip-only chunks, as gdal2h5 writes them."""
+    chunks = dset.chunks
+    return (chunks is not None and chunks[:2] == (tile_size, tile_size) and chunks[2:] == dset.shape[2:]
+            and dset.compression == "gzip" and not dset.shuffle and not dset.fletcher32 and dset.scaleoffset is None)
+
+def read_block(dset, row_start, col_start, tile_size):
+    """
+    Stored values of the tile at (row_start, col_start), cut at the dataset edges. Tiles on the
+    chunk grid of a gzip dataset are read with read_direct_chunk and inflated here, where zlib
+    releases the GIL; everything else is an ordinary h5py read.
+    """
+    if row_start % tile_size or col_start % tile_size or not _direct_chunks(dset, tile_size):
+        return dset[row_start:row_start + tile_size, col_start:col_start + tile_size]
+    offsets = (row_start, col_start) + (0,) * (dset.ndim - 2)
+    try:
+        filter_mask, raw = dset.id.read_direct_chunk(offsets)
+    except RuntimeError:
+        # chunk never written (an empty tile): fill value, like a normal read
+        data = np.full(dset.chunks, dset.fillvalue, dtype=dset.dtype)
+    else:
+        if not filter_mask & 1:
+            raw = zlib.decompress(raw)
+        data = np.frombuffer(raw, dtype=dset.dtype).reshape(dset.chunks)
+    # edge chunks hold padding beyond the dataset
+    return data[:dset.shape[0] - row_start, :dset.shape[1] - col_start]
+
+def read_feature_tile(source, row_start, col_start, tile_size):
+    """(tile_size, tile_size, C) features at (row_start, col_start), zero-padded at the edges."""
+    if isinstance(source, tuple):
+        dset, indices = source
+        data = read_block(dset, row_start, col_start, tile_size)
+        if indices != list(range(dset.shape[2])):
+            data = data[..., indices]
+        data = decode_features(data, dset.attrs)
+    else:
+        data = np.stack([decode_features(read_block(dset, row_start, col_start, tile_size), dset.attrs)
+                         for dset in source], axis=-1)
+    return _pad(data, tile_size)
+
+def label_dataset(h5file, name="labels_2017"):
+    """labels/{name} as the readers address it, or the root-level dataset gdal2h5 writes in the band layout."""
+    return h5file[f"labels/{name}"] if f"labels/{name}" in h5file else h5file[name]
+
+def read_label_tile(dset, row_start, col_start, tile_size):
+    return _pad(read_block(dset, row_start, col_start, tile_size), tile_size)
+
+def tile_index(h5file, dset):
+    """Tile index entry of a dataset (valid fraction or label class histogram per tile), or None."""
+    name = f"tile_index{dset.name}"
+    return h5file[name][...] if name in h5file else None
+
+def useful_tiles(h5file, source, tile_size, tiles, min_valid=0.0, label_dset=None, classes=None):
+    """
+    The (row_start, col_start) origins from `tiles` whose features are not empty and at least
+    `min_valid` valid in every band, and, with label_dset and classes, whose labels contain one of
+    `classes`. Origins must lie on the tile grid of the file; without a tile index all of them pass.
+    """
+    if "tile_size" in h5file.attrs and h5file.attrs["tile_size"] != tile_size:
+        raise ValueError(f"Tile index is on a {h5file.attrs['tile_size']} px grid, not {tile_size}")
+    dsets = [source[0]] if isinstance(source, tuple) else source
+    fractions = [index for index in (tile_index(h5file, dset) for dset in dsets) if index is not None]
+    keep = None
+    if fractions:
+        fraction = np.minimum.reduce(fractions)
+        keep = (fraction > 0) & (fraction >= min_valid)
+    if label_dset is not None and classes is not None:
+        counts = tile_index(h5file, label_dset)
+        if counts is not None:
+            has_class = counts[..., list(classes)].sum(axis=-1) > 0
+            keep = has_class if keep is None else keep & has_class
+    if keep is None:
+        return list(tiles)
+    return [(row, col) for row, col in tiles if keep[row // tile_size, col // tile_size]]
@@ -5,14 +5,24 @@ import time
 from tensorflow.keras.callbacks import ModelCheckpoint
 from train_model import train_model
 from predict_patches import predict_and_export
+from h5_tiles import feature_source, label_dataset, read_feature_tile, read_label_tile, useful_tiles
+from h5_dataset import H5TileStream, tile_rows
 
 # Configuration
 h5_file_path = "ard.h5"
 output_dir = "model_outputs"
 checkpoint_dir = "checkpoints"
 chunk_size = 256
+# Tiles less valid than this (see the tile index in h5_tiles.useful_tiles) are left out of training
+min_valid_fraction = 0.5
 batch_size = 8
 epochs = 10
+# Stream training tiles from ard.h5 (every tile of the training rows, across the full width) with
+# decode_workers reader threads and prefetch_batches batches read ahead, instead of loading the
+# first tile of every row chunk into memory
+stream_training = True
+decode_workers = 4
+prefetch_batches = 4
 
 # Dataset Metadata
 total_rows = #write your extent and region metadata
@@ -29,29 +39,16 @@ os.makedirs(output_dir, exist_ok=True)
 os.makedirs(checkpoint_dir, exist_ok=True)
 
 def load_data_by_chunks(h5_file_path, feature_layers, chunk_indices):
-    """Load features and labels from HDF5 in chunks."""
+    """Load features and labels from HDF5 in chunks (band or interleaved layout, see h5_tiles)."""
     with h5py.File(h5_file_path, "r") as h5file:
+        source = feature_source(h5file, feature_layers)
+        label_dset = label_dataset(h5file)
+        tiles = useful_tiles(h5file, source, chunk_size, [(idx * chunk_size, 0) for idx in chunk_indices],
+                             min_valid=min_valid_fraction)
         features, labels = [], []
-        for idx in chunk_indices:
-            row_start = idx * chunk_size
-            row_end = min(row_start + chunk_size, h5file["labels/labels_2017"].shape[0])
-
-            feature_chunk = np.stack([
-                np.pad(
-                    h5file[f"/features/{layer}"][row_start:row_end, :chunk_size],
-                    ((0, chunk_size - (row_end - row_start)), (0, 0)),
-                    mode="constant"
-                ) for layer in feature_layers
-            ], axis=-1)
-
-            label_chunk = np.pad(
-                h5file["labels/labels_2017"][row_start:row_end, :chunk_size],
-                ((0, chunk_size - (row_end - row_start)), (0, 0)),
-                mode="constant"
-            )
-
-            features.append(feature_chunk)
-            labels.append(label_chunk)
+        for row_start, col_start in tiles:
+            features.append(read_feature_tile(source, row_start, col_start, chunk_size))
+            labels.append(read_label_tile(label_dset, row_start, col_start, chunk_size))
 
     return np.array(features), np.array(labels)
 
@@ -60,12 +57,22 @@ models = [('model1', ['B04_20m.vrt', 'B11_20m.vrt', 'B12_20m.vrt'])]
 for model_name, feature_layers in models:
     print(f"Processing {model_name}")
     
-    train_features, train_labels = load_data_by_chunks(h5_file_path, feature_layers, train_split)
-    valid_features, valid_labels = load_data_by_chunks(h5_file_path, feature_layers, valid_split)
+    if stream_training:
+        patches = {
+            split: H5TileStream(h5_file_path, feature_layers,
+                                tile_rows(h5_file_path, feature_layers, rows, chunk_size, min_valid_fraction),
+                                chunk_size, batch_size, shuffle=split == "train",
+                                workers=decode_workers, prefetch=prefetch_batches)
+            for split, rows in (("train", train_split), ("valid", valid_split))
+        }
+    else:
+        train_features, train_labels = load_data_by_chunks(h5_file_path, feature_layers, train_split)
+        valid_features, valid_labels = load_data_by_chunks(h5_file_path, feature_layers, valid_split)
+        patches = {"train": (train_features, train_labels), "valid": (valid_features, valid_labels)}
 
     train_model(
         model_name=model_name,
-        patches={"train": (train_features, train_labels), "valid": (valid_features, valid_labels)},
+        patches=patches,
         num_classes=3,
         output_dir=output_dir,
         batch_size=batch_size,
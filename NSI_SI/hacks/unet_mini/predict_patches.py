@@ -5,6 +5,7 @@ import h5py
 from pathlib import Path
 from tensorflow.keras.models import load_model
 import subprocess
+from h5_tiles import feature_source, feature_shape, read_feature_tile, useful_tiles
 
 # GRASS GIS Configuration
 os.environ["GISBASE"] = "/usr/local/grass84"
@@ -23,50 +24,42 @@ gisdbase = Path("/path/to/grass_baza/")
 session = gj.init(Path(gisdbase, "some_project"))
 os.environ['GRASS_OVERWRITE'] = '0'  # Overwriting not permitted, by default is 1, so do as you dare
 
-def predict_and_export(model_path, h5_file_path, feature_layers, chunk_indices, output_layer, chunk_size):
+def predict_and_export(model_path, h5_file_path, feature_layers, chunk_indices, output_layer, chunk_size,
+                       min_valid_fraction=0.0):
     print(f"Loading model from {model_path}")
     model = load_model(model_path)
 
     with h5py.File(h5_file_path, "r") as h5file:
-        n_rows, n_cols = h5file[f"/features/{feature_layers[0]}"].shape
+        source = feature_source(h5file, feature_layers)
+        n_rows, n_cols = feature_shape(source)
 
-    predictions = np.zeros((n_rows, n_cols), dtype=np.uint8)
+        predictions = np.zeros((n_rows, n_cols), dtype=np.uint8)
 
-    print(f"Processing {len(chunk_indices)} chunks...")
-    for chunk_idx in chunk_indices:
-        row_start = chunk_idx * chunk_size
-        row_end = min(row_start + chunk_size, n_rows)
+        print(f"Processing {len(chunk_indices)} chunks...")
+        for chunk_idx in chunk_indices:
+            row_start = chunk_idx * chunk_size
+            row_end = min(row_start + chunk_size, n_rows)
 
-        chunk_features = []
-        with h5py.File(h5_file_path, "r") as h5file:
-            for col_start in range(0, n_cols, chunk_size):
-                col_end = min(col_start + chunk_size, n_cols)
+            # empty tiles (and those below min_valid_fraction) stay 0 in the output
+            tiles = useful_tiles(h5file, source, chunk_size, [(row_start, col_start) for col_start in range(0, n_cols, chunk_size)],
+                                 min_valid=min_valid_fraction)
+            if not tiles:
+                continue
+            chunk_features = [read_feature_tile(source, row_start, col_start, chunk_size) for _, col_start in tiles]
+
+            X_test = np.array(chunk_features)
+
+            print(f"Predicting chunk {chunk_idx + 1}/{len(chunk_indices)}...")
+            predictions_chunk = model.predict(X_test)
 
-                tile = []
-                for layer in feature_layers:
-                    layer_data = h5file[f"/features/{layer}"][row_start:row_end, col_start:col_end]
-                    if layer_data.shape != (chunk_size, chunk_size):
-                        layer_data = np.pad(
-                            layer_data,
-                            ((0, chunk_size - layer_data.shape[0]), (0, chunk_size - layer_data.shape[1])),
-                            mode="constant",
-                        )
-                    tile.append(layer_data)
-                chunk_features.append(np.stack(tile, axis=-1))
-
-        X_test = np.array(chunk_features)
-
-        print(f"Predicting chunk {chunk_idx + 1}/{len(chunk_indices)}...")
-        predictions_chunk = model.predict(X_test)
-
-        if predictions_chunk.shape[-1] > 1:
-            predictions_chunk = np.argmax(predictions_chunk, axis=-1)
-        else:
-            predictions_chunk = (predictions_chunk > 0.5).astype(np.uint8)
-
-        for i, col_start in enumerate(range(0, n_cols, chunk_size)):
-            col_end = min(col_start + chunk_size, n_cols)
-            predictions[row_start:row_end, col_start:col_end] = predictions_chunk[i, :row_end - row_start, :col_end - col_start]
+            if predictions_chunk.shape[-1] > 1:
+                predictions_chunk = np.argmax(predictions_chunk, axis=-1)
+            else:
+                predictions_chunk = (predictions_chunk > 0.5).astype(np.uint8)
+
+            for i, (_, col_start) in enumerate(tiles):
+                col_end = min(col_start + chunk_size, n_cols)
+                predictions[row_start:row_end, col_start:col_end] = predictions_chunk[i, :row_end - row_start, :col_end - col_start]
 
     print(f"Finished predictions. Writing to GRASS GIS layer: {output_layer}")
     write_raster_grass(predictions, output_layer)
@@ -7,12 +7,16 @@ def train_model(model_name, patches, num_classes, output_dir, batch_size, epochs
     if "train" not in patches or "valid" not in patches:
         raise ValueError("Patches dictionary must contain 'train' and 'valid' keys.")
 
-    # Extract train and validation data
-    X_train, y_train = patches["train"]
-    X_valid, y_valid = patches["valid"]
+    # Arrays, or H5TileStreams (h5_dataset.py) that read and prefetch batches while the model trains
+    streaming = not isinstance(patches["train"], tuple)
+    if streaming:
+        input_shape = patches["train"].input_shape
+    else:
+        X_train, y_train = patches["train"]
+        X_valid, y_valid = patches["valid"]
 
-    # Get input shape based on feature layers
-    input_shape = X_train.shape[1:]  # Automatically determine input shape
+        # Get input shape based on feature layers
+        input_shape = X_train.shape[1:]  # Automatically determine input shape
 
     # Initialize UNet model
     model = UNet(input_shape, num_classes)
@@ -37,15 +41,27 @@ def train_model(model_name, patches, num_classes, output_dir, batch_size, epochs
     callbacks.append(checkpoint)
 
     # Train the model
-    model.fit(
-        X_train,
-        y_train,
-        validation_data=(X_valid, y_valid),
-        epochs=epochs,
-        batch_size=batch_size,
-        callbacks=callbacks,
-        verbose=verbose,
-    )
+    if streaming:
+        # the streams are endless and batched already; one epoch is one pass over their tiles
+        model.fit(
+            iter(patches["train"]),
+            steps_per_epoch=len(patches["train"]),
+            validation_data=iter(patches["valid"]),
+            validation_steps=len(patches["valid"]),
+            epochs=epochs,
+            callbacks=callbacks,
+            verbose=verbose,
+        )
+    else:
+        model.fit(
+            X_train,
+            y_train,
+            validation_data=(X_valid, y_valid),
+            epochs=epochs,
+            batch_size=batch_size,
+            callbacks=callbacks,
+            verbose=verbose,
+        )
 
     # Save the final trained model
     final_model_path = os.path.join(output_dir, f"{model_name}_final.h5")